@@ -0,0 +1,80 @@
+import hmac
+import base64
+from os import getenv
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from . import metrics
+from . import profiler
+from . import sketch
+from . import transfer
+
+# Admin endpoints are only available when
+# an ADMIN_TOKEN is set in the environment
+# and must be passed as a bearer token.
+ADMIN_TOKEN = getenv('ADMIN_TOKEN')
+PROFILE_MAX_SECONDS = 60
+ALLOCATIONS_MAX_SECONDS = 3600
+
+def require_admin(authorization: str = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(403, 'admin access is disabled')
+
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() != 'bearer' or \
+        not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(401, 'invalid admin token')
+
+router = APIRouter(prefix='/admin', dependencies=[Depends(require_admin)])
+
+@router.get('/metrics')
+async def get_metrics():
+    return PlainTextResponse(metrics.render())
+
+@router.get('/hot')
+async def get_hot(limit: int = 20):
+    # The busiest keys of each kind, base 64 encoded
+    return {
+        name: [{
+            'key': base64.urlsafe_b64encode(key).decode(),
+            'count': count
+        } for key, count in hitters.most_common(limit)]
+        for name, hitters in sketch.sketches.items()
+    }
+
+@router.get('/allocations')
+async def get_allocations(seconds: float = 10, limit: int = 50):
+    if not 0 < seconds <= ALLOCATIONS_MAX_SECONDS:
+        raise HTTPException(422, f'seconds must be between 0 and {ALLOCATIONS_MAX_SECONDS}')
+
+    stats = await profiler.allocations(seconds, limit)
+    if stats is None:
+        raise HTTPException(409, 'allocations are already being traced')
+    return stats
+
+@router.get('/profile')
+async def get_profile(seconds: float = 10, interval: float = 0.005):
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(422, f'seconds must be between 0 and {PROFILE_MAX_SECONDS}')
+    if not 0.001 <= interval <= 1:
+        raise HTTPException(422, 'interval must be between 0.001 and 1')
+
+    collapsed = await profiler.profile(seconds, interval)
+    if collapsed is None:
+        raise HTTPException(409, 'a profile is already running')
+
+    return PlainTextResponse(collapsed, headers={
+        'Content-Disposition': 'attachment; filename="profile.folded"'
+    })
+
+@router.get('/links')
+async def export_links():
+    # All live links, as a stream of records (see transfer.py)
+    return StreamingResponse(transfer.export_links(),
+        media_type='application/octet-stream',
+        headers={ 'Content-Disposition': 'attachment; filename="links.bin"' })
+
+@router.post('/links')
+async def import_links(request: Request):
+    # Links exported by another deployment, which are
+    # verified and written just as if they were put
+    return await transfer.import_links(request.stream())
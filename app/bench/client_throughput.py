@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import asyncio
+import argparse
+from time import time, perf_counter
+from random import randbytes
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from ..client import LinkClient, Editor
+from ..test.utils import URL_BASE, put
+
+# Measures the client library: puts per second through its
+# pooled session, against the test utilities which open a
+# session per put, and then how quickly one multiplexed
+# stream gets through the backlogs of many info hashes.
+#
+#   python -m app.bench.client_throughput
+
+async def pooled_puts(client, editors, puts):
+    async def writer(editor, info_hash, pok):
+        for counter in range(puts):
+            await client.put(editor, editor.sign(info_hash, pok, counter, int(time()) + 1000, randbytes(16)))
+    await asyncio.gather(*(writer(editor, *editor.prove(Ed25519PrivateKey.generate())) for editor in editors))
+
+async def unpooled_puts(editors, puts):
+    async def writer(editor, info_hash, pok):
+        for counter in range(puts):
+            await put(editor.public_key, editor.private_key, 0, info_hash, pok,
+                counter, int(time()) + 1000, randbytes(16))
+    await asyncio.gather(*(writer(editor, *editor.prove(Ed25519PrivateKey.generate())) for editor in editors))
+
+async def main(args):
+    async with LinkClient(args.url) as client:
+        for name, run in [
+            ('pooled', lambda: pooled_puts(client, [Editor() for _ in range(args.writers)], args.puts)),
+            ('session per put', lambda: unpooled_puts([Editor() for _ in range(args.writers)], args.puts))
+        ]:
+            start = perf_counter()
+            await run()
+            seconds = perf_counter() - start
+            print(f'{name}: {args.writers * args.puts / seconds:.0f} puts/s')
+
+        remaining = args.info_hashes
+        done = asyncio.Event()
+        def completed(info_hashes):
+            nonlocal remaining
+            remaining -= len(info_hashes)
+            if remaining <= 0: done.set()
+
+        stream = await client.stream(on_backlog_complete=completed)
+        info_hashes = [randbytes(32) for _ in range(args.info_hashes)]
+        start = perf_counter()
+        await asyncio.gather(*(
+            stream.subscribe(info_hashes[i:i+args.per_subscribe])
+            for i in range(0, len(info_hashes), args.per_subscribe)))
+        await done.wait()
+        seconds = perf_counter() - start
+        print(f'subscribed: {args.info_hashes / seconds:.0f} info hashes/s')
+        await stream.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default=URL_BASE)
+    parser.add_argument('--writers', type=int, default=32)
+    parser.add_argument('--puts', type=int, default=50, help='puts per writer')
+    parser.add_argument('--info-hashes', type=int, default=10000)
+    parser.add_argument('--per-subscribe', type=int, default=100)
+    asyncio.run(main(parser.parse_args()))
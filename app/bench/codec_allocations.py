@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import struct
+import argparse
+import tracemalloc
+from timeit import timeit
+from random import randbytes
+from .. import codec
+
+# Measures the bytes allocated, and time taken, to parse and
+# build each kind of message with the codec against the
+# slicing it replaced. Runs on its own, with no service:
+#
+#   python -m app.bench.codec_allocations
+
+def legacy_container(container_signed):
+    container, signature = container_signed[:-64], container_signed[-64:]
+    fields = struct.unpack('!B32s64sqq', container[:struct.calcsize('!B32s64sqq')])
+    payload = container[struct.calcsize('!B32s64sqq'):]
+    return fields, container, signature, payload
+
+def codec_container(container_signed):
+    return codec.unpack_container(container_signed)
+
+def legacy_request(msg):
+    version, request, message_id = struct.unpack('!BB16s', msg[:18])
+    body = msg[18:]
+    return [body[i:i+32] for i in range(0, len(body), 32)]
+
+def codec_request(msg):
+    version, request, message_id, body = codec.unpack_request(msg)
+    return codec.split_info_hashes(body)
+
+def legacy_announce(args):
+    return struct.pack('!B32s32s', 0, args[0], args[1]) + args[2]
+
+def codec_announce(args):
+    return codec.pack_announce(*args)
+
+def legacy_backlog_complete(info_hashes):
+    return struct.pack('!B', 4) + b''.join(info_hashes)
+
+def codec_backlog_complete(info_hashes):
+    return codec.pack_backlog_complete(info_hashes)
+
+def allocated(function, message):
+    # Everything the call allocates, whether it is
+    # freed before returning or part of the result
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    result = function(message)
+    _, peak = tracemalloc.get_traced_memory()
+    del result
+    return peak - before
+
+def main(args):
+    container_signed = codec.pack_container(0, randbytes(32), randbytes(64), 1, 2, randbytes(256)) + randbytes(64)
+    info_hashes = [randbytes(32) for _ in range(args.info_hashes)]
+    cases = [
+        ('put container', container_signed, legacy_container, codec_container),
+        (f'subscribe ({args.info_hashes} info hashes)',
+            codec.pack_request(codec.RequestHeader.SUBSCRIBE, randbytes(16), info_hashes),
+            legacy_request, codec_request),
+        ('announce', (randbytes(32), randbytes(32), container_signed), legacy_announce, codec_announce),
+        (f'backlog complete ({args.info_hashes} info hashes)', info_hashes,
+            legacy_backlog_complete, codec_backlog_complete)
+    ]
+
+    tracemalloc.start()
+    for name, message, legacy, new in cases:
+        print(name)
+        for label, function in [('slicing', legacy), ('codec', new)]:
+            function(message) # warm up
+            nbytes = min(allocated(function, message) for _ in range(args.repeat))
+            tracemalloc.stop()
+            seconds = timeit(lambda: function(message), number=args.number) / args.number
+            tracemalloc.start()
+            print(f'  {label:8} {nbytes:8d} B allocated  {1e6 * seconds:8.2f} us')
+    tracemalloc.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--info-hashes', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--number', type=int, default=10000)
+    main(parser.parse_args())
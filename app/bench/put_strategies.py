@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import struct
+import asyncio
+import argparse
+from time import time, perf_counter
+from random import randbytes, random
+from motor.motor_asyncio import AsyncIOMotorClient
+from ..db import write_link, revision_format
+
+# Compares database latency and server CPU for two ways
+# of conditionally writing a link, run directly against
+# a scratch collection:
+#
+# - filtered: db.write_link, which is what rest.put uses
+# - pipeline: the single aggregation pipeline upsert with
+#   a $cond per field that rest.put used previously
+#
+#   python -m app.bench.put_strategies
+
+async def write_link_pipeline(db, link):
+    counter, expiration = link['counter'], link['expiration']
+
+    def conditional_field(name, variable):
+        return { name: { "$cond": {
+            "if": { "$and": [
+                { "$lt": ["$counter", counter] },
+                { "$lte": ["$expiration", expiration] }
+            ]},
+            "then": variable,
+            "else": f"${name}"
+        }}}
+
+    return await db.find_one_and_update({
+        "editor_public_key": link['editor_public_key'],
+    }, [{
+        "$set": { "editor_public_key": link['editor_public_key'] } |
+        conditional_field("counter", counter) |
+        conditional_field("expiration", expiration) |
+        conditional_field("info_hash", link['info_hash']) |
+        conditional_field("container_signed", link['container_signed']) |
+        conditional_field("prev_info_hash", { "$cond": {
+            "if": { "$ne": ["$info_hash", link['info_hash']] },
+            "then": "$info_hash",
+            "else": "$$REMOVE"
+        }}) |
+        conditional_field("revision",
+            struct.pack(revision_format, link['editor_public_key'], counter)) |
+        conditional_field("expired", "$$REMOVE")
+    }], upsert=True)
+
+STRATEGIES = {
+    'filtered': write_link,
+    'pipeline': write_link_pipeline
+}
+
+async def server_cpu(client):
+    # Microseconds of CPU the server has used
+    status = await client.admin.command('serverStatus')
+    extra = status.get('extra_info', {})
+    return extra.get('user_time_us', 0) + extra.get('system_time_us', 0)
+
+async def writer(db, write, num_writes, conflict_rate, latencies):
+    editor_public_key = randbytes(32)
+    info_hashes = [randbytes(32) for _ in range(2)]
+    expiration = int(time()) + 1000
+    counter = 0
+
+    for i in range(num_writes):
+        # Some fraction of writes repeat the last
+        # counter, and so conflict
+        if i == 0 or random() >= conflict_rate:
+            counter += 1
+        link = {
+            'editor_public_key': editor_public_key,
+            'counter': counter,
+            'expiration': expiration,
+            'info_hash': info_hashes[i % 2],
+            'container_signed': randbytes(300)
+        }
+        start = perf_counter()
+        await write(db, link)
+        latencies.append(perf_counter() - start)
+
+async def run(client, name, args):
+    db = client.graffiti_bench[name]
+    await db.drop()
+    await db.create_index('editor_public_key', unique=True)
+
+    latencies = []
+    cpu_start = await server_cpu(client)
+    start = perf_counter()
+    await asyncio.gather(*[
+        writer(db, STRATEGIES[name], args.writes, args.conflict_rate, latencies)
+        for _ in range(args.writers)
+    ])
+    elapsed = perf_counter() - start
+    cpu = await server_cpu(client) - cpu_start
+    await db.drop()
+
+    latencies.sort()
+    print(f'{name}:')
+    print(f'  throughput:       {len(latencies)/elapsed:.1f} writes/s')
+    print(f'  latency p50:      {1000*latencies[len(latencies)//2]:.2f} ms')
+    print(f'  latency p99:      {1000*latencies[int(len(latencies)*.99)]:.2f} ms')
+    print(f'  server cpu/write: {cpu/len(latencies):.1f} us')
+
+async def main(args):
+    client = AsyncIOMotorClient('mongo')
+    for name in STRATEGIES:
+        await run(client, name, args)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', type=int, default=32)
+    parser.add_argument('--writes', type=int, default=200, help='writes per writer')
+    parser.add_argument('--conflict-rate', type=float, default=0.1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import asyncio
+import argparse
+from time import time, perf_counter
+from random import randbytes
+from motor.motor_asyncio import AsyncIOMotorClient
+from ..test.utils import editor_public_private_keys, generate_info_hash_and_pok, put
+
+# Measures how many PUTs per second the service accepts.
+#
+# Pass --pre-images to turn change stream pre-images back
+# on for the duration of the run, which is how the links
+# collection was configured before they were removed,
+# to compare write throughput before and after.
+#
+#   python -m app.bench.put_throughput
+#   python -m app.bench.put_throughput --pre-images
+
+async def set_pre_images(enabled):
+    await AsyncIOMotorClient('mongo').graffiti.command(
+        'collMod', 'links',
+        changeStreamPreAndPostImages={'enabled': enabled})
+
+async def writer(num_puts, results):
+    # Each writer repeatedly updates its own link,
+    # moving it between two info hashes
+    editor_public_key, editor_private_key = editor_public_private_keys()
+    info_hashes = [generate_info_hash_and_pok(editor_public_key)[:2] for _ in range(2)]
+    expiration = int(time()) + 1000
+
+    for counter in range(num_puts):
+        info_hash, pok = info_hashes[counter % 2]
+        start = perf_counter()
+        _, _, status, _ = await put(
+            editor_public_key,
+            editor_private_key,
+            0,
+            info_hash,
+            pok,
+            counter,
+            expiration,
+            randbytes(100))
+        results.append((status, perf_counter() - start))
+
+async def main(args):
+    if args.pre_images:
+        await set_pre_images(True)
+
+    try:
+        results = []
+        start = perf_counter()
+        await asyncio.gather(*[
+            writer(args.puts, results) for _ in range(args.writers)
+        ])
+        elapsed = perf_counter() - start
+    finally:
+        if args.pre_images:
+            await set_pre_images(False)
+
+    latencies = sorted(latency for _, latency in results)
+    failures = sum(1 for status, _ in results if status != 200)
+    print(f'pre-images:  {"on" if args.pre_images else "off"}')
+    print(f'puts:        {len(results)} ({failures} failed)')
+    print(f'throughput:  {len(results)/elapsed:.1f} puts/s')
+    print(f'latency p50: {1000*latencies[len(latencies)//2]:.2f} ms')
+    print(f'latency p99: {1000*latencies[int(len(latencies)*.99)]:.2f} ms')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', type=int, default=32)
+    parser.add_argument('--puts', type=int, default=100, help='puts per writer')
+    parser.add_argument('--pre-images', action='store_true')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import json
+import base64
+import asyncio
+import argparse
+import aiohttp
+from time import perf_counter
+from collections import defaultdict
+from ..test.utils import URL_BASE
+
+# Replays traffic recorded by the capture middleware
+# (see capture.py) against a service instance, keeping
+# the recorded spacing between requests, optionally sped
+# up. Each captured websocket is reopened and sent the
+# same messages at the same offsets.
+#
+#   python -m app.bench.replay capture.*.jsonl
+#   python -m app.bench.replay capture.*.jsonl --speed 10
+#
+# Puts replayed against the database they were captured
+# from are rejected as stale (409) but cost the service
+# almost exactly what they did originally.
+
+def load(paths):
+    events = []
+    for path in paths:
+        with open(path) as f:
+            events += [json.loads(line) for line in f if line.strip()]
+    # Ties are broken by file order, so replays are repeatable
+    events.sort(key=lambda event: event['time'])
+    return events
+
+def target(url, event):
+    # Captures from before queries were recorded have none
+    query = event.get('query')
+    return url + event['path'].lstrip('/') + ('?' + query if query else '')
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0
+
+async def main(args):
+    events = load(args.captures)
+    if not events:
+        return print('nothing to replay')
+
+    origin = events[0]['time']
+    start = perf_counter()
+    latencies = defaultdict(list)
+    statuses = defaultdict(int)
+    sockets = {} # captured socket id -> queue of messages
+    tasks = []
+
+    async def at(event):
+        # Sleep until the event's (scaled) offset
+        delay = (event['time'] - origin) / args.speed - (perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def request(session, event):
+        began = perf_counter()
+        try:
+            async with session.request(
+                event['method'],
+                target(args.url, event),
+                data=base64.urlsafe_b64decode(event['body'])) as response:
+                await response.read()
+                statuses[response.status] += 1
+        except aiohttp.ClientError:
+            statuses['error'] += 1
+        latencies[event['method']].append(perf_counter() - began)
+
+    async def websocket(session, event, queue):
+        received = 0
+        try:
+            async with session.ws_connect(target(args.url.replace('http', 'ws', 1), event)) as ws:
+                async def drain():
+                    nonlocal received
+                    async for message in ws:
+                        received += 1
+                draining = asyncio.create_task(drain())
+
+                while (message := await queue.get()) is not None:
+                    await ws.send_bytes(message)
+                await ws.close()
+                await draining
+        except aiohttp.ClientError:
+            statuses['ws_error'] += 1
+        statuses['ws_messages_received'] += received
+
+    async with aiohttp.ClientSession() as session:
+        for event in events:
+            await at(event)
+            if event['type'] == 'http':
+                tasks.append(asyncio.create_task(request(session, event)))
+            elif event['type'] == 'ws_open':
+                sockets[event['socket']] = queue = asyncio.Queue()
+                tasks.append(asyncio.create_task(websocket(session, event, queue)))
+            elif event['socket'] in sockets:
+                if event['type'] == 'ws_message':
+                    sockets[event['socket']].put_nowait(base64.urlsafe_b64decode(event['bytes']))
+                else:
+                    sockets.pop(event['socket']).put_nowait(None)
+
+        # Close sockets whose capture ended before they did
+        for queue in sockets.values():
+            queue.put_nowait(None)
+        await asyncio.gather(*tasks)
+
+    seconds = perf_counter() - start
+    print(f'replayed {len(events)} events in {seconds:.2f}s ' +
+          f'({(events[-1]["time"] - origin):.2f}s captured, {args.speed}x)')
+    for method, values in sorted(latencies.items()):
+        print(f'{method}: {len(values)} requests, ' +
+              f'p50 {1000 * percentile(values, 0.5):.2f}ms, ' +
+              f'p99 {1000 * percentile(values, 0.99):.2f}ms')
+    print(dict(statuses))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('captures', nargs='+')
+    parser.add_argument('--url', default=URL_BASE)
+    parser.add_argument('--speed', type=float, default=1, help='1 replays in real time, 10 ten times faster')
+    asyncio.run(main(parser.parse_args()))
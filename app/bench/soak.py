@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import sys
+import random
+import asyncio
+import argparse
+import aiohttp
+from os import getenv
+from time import perf_counter
+from ..codec import RequestHeader, pack_request
+from ..test.utils import URL_BASE
+
+# Churns many websocket clients against one instance for a
+# long time while sampling its memory, tasks and subscription
+# index through the admin endpoints, and fails if any of them
+# keeps growing. Each client connects, subscribes to a few
+# info hashes from a shared pool, maybe unsubscribes from
+# some, and disconnects, cleanly or not, over and over.
+#
+# Run it against a single worker (WORKERS=1) with an
+# ADMIN_TOKEN set, since each worker reports for itself:
+#
+#   python -m app.bench.soak --clients 2000 --duration 600
+
+SERIES = [
+    'process_resident_memory_bytes',
+    'event_loop_tasks',
+    'pubsub_sockets',
+    'pubsub_subscribed_info_hashes',
+    'pubsub_backlog_info_hashes',
+    'backlog_running',
+    'backlog_queued'
+]
+
+# Once the churn stops, these must all go back to zero
+DRAINED = [
+    'pubsub_sockets',
+    'pubsub_subscribed_info_hashes',
+    'pubsub_backlog_info_hashes',
+    'backlog_running',
+    'backlog_queued'
+]
+
+async def scrape(session, url):
+    async with session.get(url + 'admin/metrics') as response:
+        response.raise_for_status()
+        text = await response.text()
+    values = {}
+    for line in text.splitlines():
+        if line.startswith('#'): continue
+        name, _, value = line.rpartition(' ')
+        values[name.partition('{')[0]] = float(value)
+    return { name: values.get(name, 0) for name in SERIES }
+
+async def allocations(session, url, seconds):
+    # What was allocated over that many seconds and is still held
+    async with session.get(url + f'admin/allocations?seconds={seconds}&limit=200',
+        timeout=aiohttp.ClientTimeout(total=None)) as response:
+        response.raise_for_status()
+        return { stat['location']: stat['size'] for stat in await response.json() }
+
+def request(kind, info_hashes):
+    return pack_request(kind, random.randbytes(16), info_hashes)
+
+async def churn(session, url, pool, args, stop, counts):
+    while not stop.is_set():
+        try:
+            async with session.ws_connect(url, heartbeat=None) as ws:
+                counts['connects'] += 1
+                subscribed = random.sample(pool, random.randint(1, args.subscriptions))
+                await ws.send_bytes(request(RequestHeader.SUBSCRIBE, subscribed))
+
+                # Read for a while, unsubscribing from some part way
+                end = perf_counter() + random.uniform(0, 2 * args.lifetime)
+                unsubscribed = False
+                while perf_counter() < end:
+                    if not unsubscribed and random.random() < 0.5:
+                        await ws.send_bytes(request(RequestHeader.UNSUBSCRIBE,
+                            subscribed[:random.randint(1, len(subscribed))]))
+                        unsubscribed = True
+                    try:
+                        await asyncio.wait_for(ws.receive(), end - perf_counter())
+                    except asyncio.TimeoutError:
+                        break
+
+                # Half the time, vanish without a close handshake
+                if random.random() < 0.5:
+                    ws._response.connection.transport.abort()
+        except (aiohttp.ClientError, OSError):
+            counts['errors'] += 1
+
+def growing(samples, tolerance):
+    # Compare the peak of the last third of the run with the
+    # peak of the first third. A level that churn merely holds
+    # steady passes, a leak keeps climbing and fails.
+    third = max(1, len(samples) // 3)
+    early = max(samples[:third])
+    late = max(samples[-third:])
+    return late > early * (1 + tolerance) + 1, early, late
+
+async def main(args):
+    headers = { 'Authorization': f'Bearer {getenv("ADMIN_TOKEN")}' }
+    pool = [random.randbytes(32) for _ in range(args.info_hashes)]
+    counts = { 'connects': 0, 'errors': 0 }
+    samples = { name: [] for name in SERIES }
+    failures = []
+
+    async with aiohttp.ClientSession(headers=headers) as admin, \
+        aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as clients:
+
+        baseline = await scrape(admin, args.url)
+
+        stop = asyncio.Event()
+        workers = [asyncio.create_task(churn(clients, args.url, pool, args, stop, counts))
+            for _ in range(args.clients)]
+
+        await asyncio.sleep(args.warmup)
+        traced = asyncio.create_task(allocations(admin, args.url, args.duration))
+        start = perf_counter()
+        while perf_counter() - start < args.duration:
+            await asyncio.sleep(args.interval)
+            sample = await scrape(admin, args.url)
+            for name in SERIES:
+                samples[name].append(sample[name])
+            print(f'{perf_counter() - start:6.0f}s ' + ' '.join(
+                f'{name}={int(value)}' for name, value in sample.items()), flush=True)
+        held = await traced
+
+        stop.set()
+        await asyncio.gather(*workers)
+        await asyncio.sleep(args.settle)
+        settled = await scrape(admin, args.url)
+
+    for name in ['process_resident_memory_bytes', 'event_loop_tasks', 'pubsub_subscribed_info_hashes']:
+        grew, early, late = growing(samples[name], args.tolerance)
+        if grew:
+            failures.append(f'{name} grew from {early:.0f} to {late:.0f}')
+
+    for name in DRAINED:
+        if settled[name]:
+            failures.append(f'{name} is {settled[name]:.0f} with no clients connected')
+    if settled['event_loop_tasks'] > baseline['event_loop_tasks'] * (1 + args.tolerance) + 1:
+        failures.append(f'event_loop_tasks is {settled["event_loop_tasks"]:.0f} with no clients connected, ' +
+            f'up from {baseline["event_loop_tasks"]:.0f}')
+
+    print(f'\n{counts["connects"]} connects, {counts["errors"]} errors')
+    print('allocations that grew most while churning:')
+    growth = sorted(((size, location) for location, size in held.items()), reverse=True)
+    for size, location in growth[:10]:
+        print(f'  {size:+12d} B  {location}')
+
+    if failures:
+        print('\nFAIL\n  ' + '\n  '.join(failures))
+        sys.exit(1)
+    print('\nOK')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default=URL_BASE)
+    parser.add_argument('--clients', type=int, default=2000, help='concurrent churning clients')
+    parser.add_argument('--info-hashes', type=int, default=10000, help='size of the shared pool')
+    parser.add_argument('--subscriptions', type=int, default=50, help='most info hashes per client')
+    parser.add_argument('--lifetime', type=float, default=2, help='mean seconds each connection lasts')
+    parser.add_argument('--duration', type=float, default=600, help='seconds to sample for')
+    parser.add_argument('--warmup', type=float, default=30, help='seconds of churn before sampling')
+    parser.add_argument('--interval', type=float, default=10, help='seconds between samples')
+    parser.add_argument('--settle', type=float, default=15, help='seconds to wait after the churn stops')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='growth allowed, as a fraction')
+    asyncio.run(main(parser.parse_args()))
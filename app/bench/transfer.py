@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import asyncio
+import argparse
+import aiohttp
+from os import getenv
+from time import perf_counter
+from ..codec import unpack_records
+from ..test.utils import URL_BASE
+
+# Measures how many links per second the admin export
+# streams out, and optionally streams the export straight
+# into another deployment's import and reports its rate.
+# Both need the ADMIN_TOKEN of the services involved.
+#
+#   python -m app.bench.transfer
+#   python -m app.bench.transfer --target http://other:8000/
+
+async def main(args):
+    headers = { 'Authorization': f'Bearer {getenv("ADMIN_TOKEN")}' }
+    count = 0
+    nbytes = 0
+    start = perf_counter()
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async with session.get(args.source + 'admin/links') as response:
+            response.raise_for_status()
+
+            async def chunks():
+                nonlocal count, nbytes
+                buffer = bytearray()
+                async for chunk in response.content.iter_chunked(1 << 16):
+                    nbytes += len(chunk)
+                    buffer += chunk
+                    records, used = unpack_records(buffer)
+                    count += len(records)
+                    del buffer[:used]
+                    yield chunk
+
+            if args.target:
+                async with session.post(args.target + 'admin/links', data=chunks()) as imported:
+                    imported.raise_for_status()
+                    result = await imported.json()
+            else:
+                result = None
+                async for _ in chunks(): pass
+
+    seconds = perf_counter() - start
+    print(f'exported {count} links ({nbytes} bytes) in {seconds:.2f}s')
+    print(f'{count / seconds:.0f} links/s')
+    if result:
+        print(f'imported {result["imported"]}, conflicts {result["conflicts"]}, invalid {result["invalid"]}')
+        print(f'{result["links_per_second"]:.0f} links/s on import')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', default=URL_BASE)
+    parser.add_argument('--target')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,60 @@
+from math import ceil, exp, log
+from hashlib import blake2b
+from os import urandom
+
+class BloomFilter:
+    """
+    A Bloom filter over byte strings. It may report that
+    it contains a key that was never added (at roughly
+    error_rate once capacity keys have been added) but
+    never the reverse. Keys can't be removed, so filters
+    that track a changing set need to be rebuilt.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.num_bits = max(8, ceil(-capacity * log(error_rate) / log(2)**2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * log(2)))
+        self.bits = bytearray(ceil(self.num_bits / 8))
+        self.count = 0
+        # A random key so that the bits a key lands
+        # on can't be chosen by clients
+        self.salt = urandom(16)
+
+    def indices(self, key):
+        # Double hashing: the i-th index is h1 + i*h2
+        digest = blake2b(key, digest_size=16, key=self.salt).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        # Keys that were already present (or seemed to be)
+        # aren't counted, so repeated adds of the same key
+        # don't make the filter look full
+        new = False
+        for index in self.indices(key):
+            byte, bit = index >> 3, 1 << (index & 7)
+            if not self.bits[byte] & bit:
+                self.bits[byte] |= bit
+                new = True
+        if new:
+            self.count += 1
+
+    def __contains__(self, key):
+        return all(
+            self.bits[index >> 3] & (1 << (index & 7))
+            for index in self.indices(key))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def memory(self):
+        return len(self.bits)
+
+    @property
+    def false_positive_rate(self):
+        # The expected rate given how many keys have been added
+        return (1 - exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
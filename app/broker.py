@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+import random
+import asyncio
+import logging
+import argparse
+from os import getenv
+from collections import deque
+from .codec import (
+    BrokerHeader, broker_header, event_position, pack_broker, pack_publish,
+    unpack_publish, split_info_hashes)
+from . import metrics
+
+# How announcements get from the change stream to the
+# sockets that want them (see pubsub.watch).
+#
+# By default every worker reads the change stream itself
+# and hands each change straight to its own sockets
+# (LocalBroker). With BROKER_URL set (host:port), one
+# reader publishes each change to a broker (run with
+# python -m app.broker) as an event keyed by the info
+# hashes it concerns, and every worker subscribes only
+# to the info hashes its own sockets hold (RemoteBroker).
+# The reader is the first worker of any instance with
+# PUBLISH_CHANGES set.
+#
+# A worker that loses the broker may have missed events,
+# so it has its sockets reconnect, which reads their
+# backlogs again. Events a publisher had sent when it was
+# lost may never have arrived either, so when any publisher
+# goes the broker drops every other worker too. The broker
+# also drops workers that fall more than BROKER_BUFFER_MAX
+# bytes behind.
+BROKER_URL         = getenv('BROKER_URL')
+PUBLISH_CHANGES    = getenv('PUBLISH_CHANGES') == 'true'
+BROKER_BUFFER_MAX  = int(getenv('BROKER_BUFFER_MAX', 64 * 1024 * 1024)) # bytes
+BROKER_RETRY_MIN   = 0.5 # seconds
+BROKER_RETRY_MAX   = 10 # seconds
+
+logger = logging.getLogger(__name__)
+
+def parse_url(url):
+    host, _, port = url.rpartition(':')
+    return host, int(port)
+
+class LocalBroker:
+    # Every change is read here, so subscriptions
+    # needn't be passed on and there's nothing to wait for
+    connected = None
+
+    def __init__(self, deliver, lost):
+        self.deliver = deliver
+
+    async def run(self):
+        pass
+
+    def subscribe(self, info_hashes):
+        pass
+
+    def unsubscribe(self, info_hashes):
+        pass
+
+    async def ready(self, info_hashes):
+        return None
+
+    async def publish(self, info_hashes, event):
+        await self.deliver(event)
+
+class RemoteBroker:
+    """
+    A worker's connection to the broker. deliver is called
+    with each event for the subscribed info hashes, in order,
+    and lost whenever the connection drops.
+    """
+
+    def __init__(self, deliver, lost, url=BROKER_URL):
+        self.deliver = deliver
+        self.lost = lost
+        self.host, self.port = parse_url(url)
+        self.subscriptions = set()
+        self.pending = {} # info_hash -> acknowledgement of its subscription
+        self.acks = deque()
+        self.writer = None
+        self.ready_to_publish = asyncio.Event()
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    async def run(self):
+        attempts = 0
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                attempts += 1
+                logger.warning('connecting to the broker failed: %s', e)
+                await asyncio.sleep(random.uniform(BROKER_RETRY_MIN,
+                    min(BROKER_RETRY_MAX, BROKER_RETRY_MIN * 2 ** attempts)))
+                continue
+
+            attempts = 0
+            self.writer = writer
+            self.ready_to_publish.set()
+            if self.subscriptions:
+                self.send_subscribe(list(self.subscriptions))
+            try:
+                await self.receive(reader)
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                logger.warning('lost the broker: %s', e)
+            finally:
+                self.writer = None
+                self.ready_to_publish.clear()
+                writer.close()
+                # Nobody waits on a connection that's gone
+                while self.acks:
+                    ack = self.acks.popleft()
+                    if not ack.done():
+                        ack.set_result(None)
+                self.pending.clear()
+                metrics.increment('broker_disconnects')
+            self.lost()
+
+    async def receive(self, reader):
+        while True:
+            length, header = broker_header.unpack(await reader.readexactly(broker_header.size))
+            body = await reader.readexactly(length - 1)
+            if header == BrokerHeader.EVENT.value:
+                metrics.increment('broker_events_received')
+                await self.deliver(body)
+            elif header == BrokerHeader.SUBSCRIBED.value:
+                ack = self.acks.popleft()
+                ack.set_result(event_position.unpack(body) if body else None)
+
+    def send_subscribe(self, info_hashes):
+        ack = asyncio.get_running_loop().create_future()
+        self.acks.append(ack)
+        for info_hash in info_hashes:
+            self.pending[info_hash] = ack
+        ack.add_done_callback(lambda _: self.settle(info_hashes, ack))
+        self.writer.write(pack_broker(BrokerHeader.SUBSCRIBE, *info_hashes))
+
+    def settle(self, info_hashes, ack):
+        for info_hash in info_hashes:
+            if self.pending.get(info_hash) is ack:
+                del self.pending[info_hash]
+
+    def subscribe(self, info_hashes):
+        # Called with the info hashes this worker
+        # has only now started to care about
+        self.subscriptions.update(info_hashes)
+        if self.writer is not None and info_hashes:
+            self.send_subscribe(info_hashes)
+
+    def unsubscribe(self, info_hashes):
+        self.subscriptions.difference_update(info_hashes)
+        if self.writer is not None and info_hashes:
+            self.writer.write(pack_broker(BrokerHeader.UNSUBSCRIBE, *info_hashes))
+
+    async def ready(self, info_hashes):
+        """
+        Wait until events for the info hashes will be
+        delivered. Returns the position of the latest event
+        that may have been published before then, which
+        backlog reads must catch up to (see pubsub.py).
+        """
+        acks = { self.pending[h] for h in info_hashes if h in self.pending }
+        positions = [p for p in await asyncio.gather(*acks) if p]
+        return max(positions, default=None)
+
+    async def publish(self, info_hashes, event):
+        # Hold the change stream back rather
+        # than drop events while disconnected
+        await self.ready_to_publish.wait()
+        writer = self.writer
+        writer.write(pack_publish(info_hashes, event))
+        metrics.increment('broker_events_published')
+        try:
+            await writer.drain()
+        except ConnectionError:
+            # Seen to by run
+            pass
+
+def connect(deliver, lost):
+    if BROKER_URL:
+        return RemoteBroker(deliver, lost)
+    return LocalBroker(deliver, lost)
+
+def reads_changes(broker, is_primary_worker):
+    # Whether this worker should read the change stream
+    return isinstance(broker, LocalBroker) or (PUBLISH_CHANGES and is_primary_worker)
+
+async def serve(host, port):
+    """
+    The broker itself: it passes each published event on,
+    once, to every connection subscribed to any of its info
+    hashes. It knows nothing about what events mean beyond
+    their position.
+    """
+    subscribers = {} # info_hash -> set(writer)
+    connections = set()
+    position = b''
+
+    async def handle(reader, writer):
+        nonlocal position
+        subscriptions = set()
+        publisher = False
+        connections.add(writer)
+        try:
+            while True:
+                length, header = broker_header.unpack(await reader.readexactly(broker_header.size))
+                body = await reader.readexactly(length - 1)
+
+                if header == BrokerHeader.PUBLISH.value:
+                    publisher = True
+                    info_hashes, event = unpack_publish(body)
+                    position = bytes(event[:event_position.size])
+                    targets = set()
+                    for info_hash in info_hashes:
+                        targets.update(subscribers.get(info_hash, ()))
+                    if targets:
+                        message = pack_broker(BrokerHeader.EVENT, event)
+                        for target in targets:
+                            if target.transport.get_write_buffer_size() > BROKER_BUFFER_MAX:
+                                logger.warning('dropping a subscriber that fell behind')
+                                target.transport.abort()
+                            else:
+                                target.write(message)
+
+                elif header == BrokerHeader.SUBSCRIBE.value:
+                    for info_hash in split_info_hashes(body):
+                        subscribers.setdefault(info_hash, set()).add(writer)
+                        subscriptions.add(info_hash)
+                    writer.write(pack_broker(BrokerHeader.SUBSCRIBED, position))
+
+                elif header == BrokerHeader.UNSUBSCRIBE.value:
+                    for info_hash in split_info_hashes(body):
+                        forget(info_hash, writer)
+                        subscriptions.discard(info_hash)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            connections.discard(writer)
+            for info_hash in subscriptions:
+                forget(info_hash, writer)
+            writer.close()
+            if publisher:
+                # Whatever was in flight from it is lost
+                logger.warning('lost a publisher, dropping every worker')
+                for other in list(connections):
+                    other.transport.abort()
+
+    def forget(info_hash, writer):
+        if info_hash in subscribers:
+            subscribers[info_hash].discard(writer)
+            if not subscribers[info_hash]:
+                del subscribers[info_hash]
+
+    return await asyncio.start_server(handle, host, port)
+
+async def main(args):
+    server = await serve(args.host, args.port)
+    logger.info('broker listening on %s:%d', args.host, args.port)
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=7000)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,138 @@
+import json
+import base64
+import random
+import asyncio
+from os import getenv
+from itertools import count
+from time import time, perf_counter
+from . import metrics
+
+# Optionally records a sample of real traffic so it can be
+# replayed against another instance (see bench/replay.py).
+# CAPTURE_RATE of HTTP requests and of websockets (with all
+# of their messages) are appended as JSON lines to
+# CAPTURE_PATH, one file per worker. Everything recorded is
+# already public: paths, signed containers, info hashes,
+# timings and sizes. Headers are not recorded.
+#
+# Events are queued and written out in a thread every
+# CAPTURE_FLUSH_INTERVAL seconds, so the event loop never
+# waits on the disk. Past CAPTURE_QUEUE_MAX queued events
+# the rest are dropped (and counted) until the next flush.
+CAPTURE_RATE           = float(getenv('CAPTURE_RATE', 0))
+CAPTURE_PATH           = getenv('CAPTURE_PATH', 'capture')
+CAPTURE_FLUSH_INTERVAL = 1 # seconds
+CAPTURE_QUEUE_MAX      = 100000
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).decode()
+
+class CaptureMiddleware:
+    def __init__(self, app, rate=CAPTURE_RATE, path=CAPTURE_PATH):
+        self.app = app
+        self.rate = rate
+        self.path = path
+        self.file = None
+        self.socket_ids = count()
+        self.queue = []
+        self.flusher = None
+
+    def write(self, event):
+        if len(self.queue) >= CAPTURE_QUEUE_MAX:
+            metrics.increment('capture_events_dropped')
+            return
+        self.queue.append(json.dumps(event, separators=(',', ':')) + '\n')
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self.flush_periodically())
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(CAPTURE_FLUSH_INTERVAL)
+            if self.queue:
+                lines, self.queue = self.queue, []
+                await asyncio.to_thread(self.flush, lines)
+
+    def flush(self, lines):
+        if self.file is None:
+            worker = getenv('WORKER_INDEX', '0')
+            self.file = open(f'{self.path}.{worker}.jsonl', 'a')
+        self.file.writelines(lines)
+        self.file.flush()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket') or \
+            scope['path'].startswith('/admin') or \
+            scope['path'] in ('/livez', '/readyz') or \
+            random.random() >= self.rate:
+            return await self.app(scope, receive, send)
+
+        if scope['type'] == 'http':
+            await self.capture_http(scope, receive, send)
+        else:
+            await self.capture_websocket(scope, receive, send)
+
+    async def capture_http(self, scope, receive, send):
+        event = {
+            'type': 'http',
+            'time': time(),
+            'method': scope['method'],
+            'path': scope['path'],
+            'query': scope['query_string'].decode(),
+            'body': b'',
+            'response_size': 0
+        }
+        start = perf_counter()
+
+        async def receive_captured():
+            message = await receive()
+            if message['type'] == 'http.request':
+                event['body'] += message.get('body', b'')
+            return message
+
+        async def send_captured(message):
+            if message['type'] == 'http.response.start':
+                event['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                event['response_size'] += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_captured, send_captured)
+        finally:
+            event['duration'] = perf_counter() - start
+            event['body'] = encode(event['body'])
+            self.write(event)
+
+    async def capture_websocket(self, scope, receive, send):
+        # Unique across every worker's capture
+        socket_id = f"{getenv('WORKER_INDEX', '0')}.{next(self.socket_ids)}"
+        self.write({
+            'type': 'ws_open',
+            'time': time(),
+            'socket': socket_id,
+            'path': scope['path'],
+            'query': scope['query_string'].decode()
+        })
+        sent = 0
+
+        async def receive_captured():
+            message = await receive()
+            if message.get('bytes') is not None:
+                self.write({
+                    'type': 'ws_message',
+                    'time': time(),
+                    'socket': socket_id,
+                    'bytes': encode(message['bytes'])
+                })
+            return message
+
+        async def send_captured(message):
+            nonlocal sent
+            if message['type'] == 'websocket.send':
+                sent += len(message.get('bytes') or b'')
+            await send(message)
+
+        try:
+            await self.app(scope, receive_captured, send_captured)
+        finally:
+            self.write({ 'type': 'ws_close', 'time': time(), 'socket': socket_id, 'sent_size': sent })
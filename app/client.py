@@ -0,0 +1,296 @@
+import os
+import random
+import base64
+import asyncio
+import logging
+import aiohttp
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from .codec import (
+    RequestHeader, ResponseHeader, pack_container, pack_request, unpack_records,
+    unpack_announce, unpack_backlog_complete, unpack_reconnect, unpack_expired,
+    response_message_id, info_hash_length)
+
+# A client for services that talk to the link service.
+# HTTP requests share one pooled session, and a Stream
+# multiplexes any number of subscriptions over a single
+# websocket that reconnects and resubscribes by itself.
+#
+#   async with LinkClient('https://link.graffiti.garden/') as client:
+#       editor = Editor()
+#       info_hash, pok = editor.prove(uri_private_key)
+#       await client.put(editor, editor.sign(info_hash, pok, 0, expiration, payload))
+#
+#       stream = await client.stream(on_announce=print)
+#       await stream.subscribe([info_hash])
+
+RECONNECT_DELAY_MIN = 0.5 # seconds
+RECONNECT_DELAY_MAX = 30 # seconds
+MAX_INFO_HASHES_PER_MESSAGE = 1024
+
+logger = logging.getLogger(__name__)
+
+class LinkServiceError(Exception):
+    pass
+
+class Editor:
+    """
+    An editor's key pair, with the proofs of knowledge
+    it has made for each URI kept for reuse.
+    """
+
+    def __init__(self, private_key=None):
+        self.private_key = private_key or Ed25519PrivateKey.generate()
+        self.public_key = self.private_key.public_key().public_bytes_raw()
+        self.public_key_base64 = base64.urlsafe_b64encode(self.public_key).decode()
+        self.proofs = {} # info_hash -> proof of knowledge
+
+    def prove(self, uri_private_key):
+        # The URI's key signs the editor's key (see rest.verify_link)
+        info_hash = uri_private_key.public_key().public_bytes_raw()
+        if info_hash not in self.proofs:
+            self.proofs[info_hash] = uri_private_key.sign(self.public_key)
+        return info_hash, self.proofs[info_hash]
+
+    def sign(self, info_hash, pok, counter, expiration, payload, version=0):
+        container = pack_container(version, info_hash, pok, counter, expiration, payload)
+        return container + self.private_key.sign(container)
+
+class Announcement:
+    """
+    A link announced on a stream. Fields are views into
+    the received frame rather than copies, and compare
+    and hash like the bytes they contain.
+    """
+    __slots__ = ('editor_public_key', 'prev_info_hash', 'container_signed')
+
+    def __init__(self, editor_public_key, prev_info_hash, container_signed):
+        self.editor_public_key = editor_public_key
+        self.prev_info_hash = prev_info_hash
+        self.container_signed = container_signed
+
+    @property
+    def info_hash(self):
+        # Where the link points now (see codec.info_hash_of)
+        if self.expired:
+            return self.prev_info_hash
+        return self.container_signed[1:1 + info_hash_length]
+
+    @property
+    def expired(self):
+        return not self.container_signed
+
+class LinkClient:
+    def __init__(self, url, connections=100):
+        self.url = url if url.endswith('/') else url + '/'
+        self.connections = connections
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get(self, editor_public_key):
+        """
+        The signed container an editor last put,
+        or None if there isn't one.
+        """
+        url = self.url + base64.urlsafe_b64encode(editor_public_key).decode()
+        async with self.session.get(url) as response:
+            if response.status == 404:
+                return None
+            if response.status != 200:
+                raise LinkServiceError(await response.text())
+            return await response.read()
+
+    async def put(self, editor, container_signed):
+        """
+        Put a signed container. Returns the container it
+        replaced, if any, and raises on conflicts.
+        """
+        async with self.session.put(self.url + editor.public_key_base64, data=container_signed) as response:
+            if response.status != 200:
+                raise LinkServiceError(await response.text())
+            return await response.read() or None
+
+    async def links(self, info_hash, limit=1000):
+        """
+        Iterate over the (editor public key, signed
+        container) of every live link under an info hash.
+        """
+        url = f'{self.url}info_hash/{base64.urlsafe_b64encode(info_hash).decode()}?limit={limit}'
+        while url:
+            async with self.session.get(url) as response:
+                if response.status != 200:
+                    raise LinkServiceError(await response.text())
+                records, _ = unpack_records(await response.read())
+                next_page = response.links.get('next')
+                url = str(response.url.join(next_page['url'])) if next_page else None
+            for record in records:
+                yield record
+
+    async def stream(self, on_announce=None, on_backlog_complete=None):
+        stream = Stream(self, on_announce, on_backlog_complete)
+        await stream.connect()
+        return stream
+
+class Stream:
+    """
+    Subscriptions over one websocket. Requests are pipelined
+    and their replies matched up by message id. If the socket
+    drops, it reconnects (after the delay the service asks
+    for, if it asked) and subscribes to everything again,
+    whose backlogs are then sent again.
+
+    on_announce is called with each Announcement and
+    on_backlog_complete with a list of the info hashes
+    whose backlogs are complete, as views.
+    """
+
+    def __init__(self, client, on_announce=None, on_backlog_complete=None):
+        self.client = client
+        self.on_announce = on_announce
+        self.on_backlog_complete = on_backlog_complete
+        self.subscriptions = set()
+        self.replies = {} # message_id -> future
+        self.ws = None
+        self.connected = asyncio.Event()
+        self.reconnect_delay = None
+        self.closed = False
+        self.task = None
+
+    async def connect(self):
+        self.task = asyncio.create_task(self.run())
+        await self.connected.wait()
+
+    async def close(self):
+        self.closed = True
+        if self.ws is not None:
+            await self.ws.close()
+        if self.task is not None:
+            await self.task
+
+    async def subscribe(self, info_hashes):
+        new = [h for h in dict.fromkeys(bytes(h) for h in info_hashes) if h not in self.subscriptions]
+        self.subscriptions.update(new)
+        try:
+            await self.request(RequestHeader.SUBSCRIBE, new)
+        except LinkServiceError:
+            self.subscriptions.difference_update(new)
+            raise
+
+    async def unsubscribe(self, info_hashes):
+        old = [h for h in dict.fromkeys(bytes(h) for h in info_hashes) if h in self.subscriptions]
+        self.subscriptions.difference_update(old)
+        await self.request(RequestHeader.UNSUBSCRIBE, old)
+
+    async def request(self, request, info_hashes):
+        # Without a socket there's nothing to do: the
+        # subscriptions are all sent on reconnecting
+        if self.ws is None or not info_hashes:
+            return
+        replies = self.send(self.ws, request, info_hashes)
+        try:
+            await asyncio.gather(*replies)
+        except ConnectionError:
+            pass
+
+    def send(self, ws, request, info_hashes):
+        # Send every message before waiting on any reply
+        replies = []
+        for i in range(0, len(info_hashes), MAX_INFO_HASHES_PER_MESSAGE):
+            message_id = os.urandom(16)
+            reply = asyncio.get_running_loop().create_future()
+            self.replies[message_id] = reply
+            replies.append(reply)
+            asyncio.create_task(ws.send_bytes(pack_request(
+                request, message_id, info_hashes[i:i+MAX_INFO_HASHES_PER_MESSAGE])))
+        return replies
+
+    async def run(self):
+        attempts = 0
+        while not self.closed:
+            try:
+                async with self.client.session.ws_connect(self.client.url, params={ 'batch_expired': 'true', 'heartbeat': 'true' }) as ws:
+                    attempts = 0
+                    self.reconnect_delay = None
+                    self.ws = ws
+                    self.connected.set()
+                    if self.subscriptions:
+                        asyncio.create_task(self.resubscribe(ws, list(self.subscriptions)))
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.BINARY:
+                            self.receive(ws, message.data)
+            except aiohttp.ClientError as e:
+                logger.warning('link service stream failed: %s', e)
+            finally:
+                self.ws = None
+                self.connected.clear()
+                for reply in self.replies.values():
+                    if not reply.done():
+                        reply.set_exception(ConnectionError())
+                self.replies.clear()
+
+            if self.closed: break
+            if self.reconnect_delay is not None:
+                delay = self.reconnect_delay
+            else:
+                # Exponential backoff with full jitter
+                attempts += 1
+                delay = random.uniform(RECONNECT_DELAY_MIN,
+                    min(RECONNECT_DELAY_MAX, RECONNECT_DELAY_MIN * 2 ** attempts))
+            await asyncio.sleep(delay)
+
+    async def resubscribe(self, ws, info_hashes):
+        try:
+            await asyncio.gather(*self.send(ws, RequestHeader.SUBSCRIBE, info_hashes))
+        except ConnectionError:
+            pass
+        except LinkServiceError as e:
+            logger.warning('resubscribing failed: %s', e)
+
+    def receive(self, ws, frame):
+        header = frame[0]
+
+        if header == ResponseHeader.ANNOUNCE.value:
+            if self.on_announce:
+                self.on_announce(Announcement(*unpack_announce(frame)))
+
+        elif header == ResponseHeader.EXPIRED.value:
+            # Announced one by one, like any other expiry
+            if self.on_announce:
+                for editor_public_key, info_hash in unpack_expired(frame):
+                    self.on_announce(Announcement(editor_public_key, info_hash, b''))
+
+        elif header == ResponseHeader.BACKLOG_COMPLETE.value:
+            if self.on_backlog_complete:
+                self.on_backlog_complete(unpack_backlog_complete(frame))
+
+        elif header == ResponseHeader.SUCCESS.value:
+            reply = self.replies.pop(response_message_id(frame), None)
+            if reply and not reply.done():
+                reply.set_result(None)
+
+        elif header == ResponseHeader.ERROR_WITH_ID.value:
+            reply = self.replies.pop(response_message_id(frame), None)
+            if reply and not reply.done():
+                reply.set_exception(LinkServiceError(frame[17:].decode()))
+
+        elif header == ResponseHeader.ERROR_WITHOUT_ID.value:
+            logger.warning('link service error: %s', frame[1:].decode())
+
+        elif header == ResponseHeader.HEARTBEAT.value:
+            asyncio.create_task(ws.send_bytes(pack_request(RequestHeader.HEARTBEAT, os.urandom(16))))
+
+        elif header == ResponseHeader.RECONNECT.value:
+            # The service is going away
+            self.reconnect_delay = unpack_reconnect(frame) / 1000
+            asyncio.create_task(ws.close())
@@ -0,0 +1,241 @@
+import struct
+from enum import Enum
+
+# Every binary format the service speaks, shared by the
+# service, the client and the tests. Formats are compiled
+# once, and parsing reads fields straight out of the
+# received buffer (through memoryview) rather than slicing
+# copies of it first.
+
+# Signed containers, as put by editors:
+#
+# version:             1 byte unsigned char
+# info_hash:          32 byte Ed25519 public key
+# proof_of_knowledge: 64 byte Ed25519 signature
+# counter              8 byte signed long long
+# expiration           8 byte signed long long
+# payload:             up to 256 bytes
+# signature:          64 byte Ed25519 signature
+put_metadata_format = '!B32s64sqq'
+put_metadata = struct.Struct(put_metadata_format)
+put_metadata_length = put_metadata.size
+signature_length = 64
+payload_max_length = 256
+
+# Single fields of the metadata
+container_info_hash = struct.Struct('!32s')
+container_info_hash_offset = 1
+container_expiration = struct.Struct('!q')
+container_expiration_offset = put_metadata_length - container_expiration.size
+
+def pack_container(version, info_hash, proof_of_knowledge, counter, expiration, payload):
+    # The unsigned container, for the editor to sign
+    return put_metadata.pack(version, info_hash, proof_of_knowledge, counter, expiration) + payload
+
+def unpack_container(container_signed):
+    """
+    Returns the metadata fields followed by the signed part
+    of the container and the signature, the last two as
+    views into container_signed.
+    """
+    view = memoryview(container_signed)
+    return put_metadata.unpack_from(view) + (
+        view[:-signature_length],
+        view[-signature_length:])
+
+def info_hash_of(container_signed):
+    return container_info_hash.unpack_from(container_signed, container_info_hash_offset)[0]
+
+def expiration_of(container_signed):
+    return container_expiration.unpack_from(container_signed, container_expiration_offset)[0]
+
+# Lists of links, as in pages and bulk exports, are
+# runs of records each prefixed by a header:
+#
+# length:            2 byte unsigned short
+# editor_public_key: 32 byte Ed25519 public key
+#
+# followed by the length byte signed container
+record_header_format = '!H32s'
+record_header = struct.Struct(record_header_format)
+record_header_length = record_header.size
+
+def pack_record(editor_public_key, container_signed):
+    return record_header.pack(len(container_signed), editor_public_key) + container_signed
+
+def unpack_records(buffer):
+    """
+    Split as many whole records as there are off the
+    front of the buffer. Returns them with the number
+    of bytes they took up.
+    """
+    records = []
+    offset = 0
+    # Release the view on return so that the
+    # caller can then resize the buffer
+    with memoryview(buffer) as view:
+        while len(view) - offset >= record_header_length:
+            length, editor_public_key = record_header.unpack_from(view, offset)
+            end = offset + record_header_length + length
+            if end > len(view): break
+            records.append((editor_public_key, view[offset + record_header_length:end].tobytes()))
+            offset = end
+    return records, offset
+
+# Websocket requests are a header followed by info hashes:
+#
+# version:     1 byte unsigned char
+# request:     1 byte unsigned char (see RequestHeader)
+# message_id: 16 bytes
+msg_header_format = '!BB16s'
+msg_header = struct.Struct(msg_header_format)
+msg_header_length = msg_header.size
+info_hash_length = 32
+info_hash_format = struct.Struct('32s')
+
+class RequestHeader(Enum):
+    SUBSCRIBE   = 1
+    UNSUBSCRIBE = 0
+    HEARTBEAT   = 2
+
+class ResponseHeader(Enum):
+    ANNOUNCE         = 0
+    SUCCESS          = 1
+    ERROR_WITH_ID    = 2
+    ERROR_WITHOUT_ID = 3
+    BACKLOG_COMPLETE = 4
+    HEARTBEAT        = 5
+    RECONNECT        = 6
+    EXPIRED          = 7
+
+def pack_request(request, message_id, info_hashes=(), version=0):
+    return b''.join((msg_header.pack(version, request.value, message_id), *info_hashes))
+
+def unpack_request(msg):
+    # The header's fields and a view of the body
+    view = memoryview(msg)
+    return msg_header.unpack_from(view) + (view[msg_header_length:],)
+
+def split_info_hashes(body):
+    # Info hashes are kept as subscription keys, so each is
+    # copied once, straight out of the received message
+    return [info_hash for info_hash, in info_hash_format.iter_unpack(body)]
+
+# Responses start with a ResponseHeader byte. Enum lookups
+# are slow, so the values used when packing are kept apart
+ANNOUNCE      = ResponseHeader.ANNOUNCE.value
+SUCCESS       = ResponseHeader.SUCCESS.value
+ERROR_WITH_ID = ResponseHeader.ERROR_WITH_ID.value
+RECONNECT     = ResponseHeader.RECONNECT.value
+announce_header = struct.Struct('!B32s32s')
+expired_header = bytes((ResponseHeader.EXPIRED.value,))
+expired_entry = struct.Struct('!32s32s')
+message_id_header = struct.Struct('!B16s')
+reconnect_frame = struct.Struct('!BI')
+heartbeat_frame = bytes((ResponseHeader.HEARTBEAT.value,))
+backlog_complete_header = bytes((ResponseHeader.BACKLOG_COMPLETE.value,))
+error_without_id_header = bytes((ResponseHeader.ERROR_WITHOUT_ID.value,))
+
+def pack_announce(editor_public_key, prev_info_hash, container_signed):
+    return announce_header.pack(ANNOUNCE, editor_public_key, prev_info_hash) + container_signed
+
+def pack_expired(links):
+    # Many links expiring at once, as pairs of editor
+    # public key and info hash following the header
+    frame = [expired_header]
+    for editor_public_key, info_hash in links:
+        frame.append(editor_public_key)
+        frame.append(info_hash)
+    return b''.join(frame)
+
+def pack_success(message_id):
+    return message_id_header.pack(SUCCESS, message_id)
+
+def pack_error(message, message_id=None):
+    if message_id:
+        header = message_id_header.pack(ERROR_WITH_ID, message_id)
+    else:
+        header = error_without_id_header
+    return header + message.encode()
+
+def pack_backlog_complete(info_hashes):
+    frame = [backlog_complete_header]
+    frame.extend(info_hashes)
+    return b''.join(frame)
+
+def pack_reconnect(delay):
+    # The delay is in milliseconds
+    return reconnect_frame.pack(RECONNECT, delay)
+
+def unpack_reconnect(frame):
+    return reconnect_frame.unpack_from(frame)[1]
+
+def response_message_id(frame):
+    return message_id_header.unpack_from(frame)[1]
+
+def unpack_announce(frame):
+    """
+    Views of the editor public key, previous info
+    hash and signed container of an announcement.
+    """
+    view = memoryview(frame)
+    return view[1:33], view[33:65], view[65:]
+
+def unpack_backlog_complete(frame):
+    view = memoryview(frame)
+    return [view[i:i+info_hash_length] for i in range(1, len(view), info_hash_length)]
+
+def unpack_expired(frame):
+    # Views of the editor public key and info hash of each link
+    view = memoryview(frame)
+    return [(view[i:i+32], view[i+32:i+64]) for i in range(1, len(view), expired_entry.size)]
+
+# Announcements pass between nodes as events keyed by the
+# info hashes they concern (see broker.py). An event is the
+# cluster time of the change, so that readers can tell how
+# far the stream has got, followed by its ANNOUNCE or
+# EXPIRED frame:
+#
+# seconds:   4 byte unsigned int
+# increment: 4 byte unsigned int
+event_position = struct.Struct('!II')
+
+def pack_event(seconds, increment, frame):
+    return event_position.pack(seconds, increment) + frame
+
+def unpack_event(event):
+    # The position and the frame, as a copy to send on
+    return event_position.unpack_from(event) + (event[event_position.size:],)
+
+# Nodes and the broker exchange length prefixed messages:
+#
+# length: 4 byte unsigned int, of the rest of the message
+# type:   1 byte unsigned char (see BrokerHeader)
+#
+# SUBSCRIBE and UNSUBSCRIBE carry info hashes, PUBLISH
+# the number of info hashes, the info hashes and an
+# event, EVENT an event, and SUBSCRIBED the position
+# of the last event published before the subscription
+# took effect (or nothing, if there hasn't been one).
+class BrokerHeader(Enum):
+    SUBSCRIBE   = 0
+    UNSUBSCRIBE = 1
+    PUBLISH     = 2
+    EVENT       = 3
+    SUBSCRIBED  = 4
+
+broker_header = struct.Struct('!IB')
+publish_count = struct.Struct('!I')
+
+def pack_broker(header, *parts):
+    body = b''.join(parts)
+    return broker_header.pack(len(body) + 1, header.value) + body
+
+def pack_publish(info_hashes, event):
+    return pack_broker(BrokerHeader.PUBLISH, publish_count.pack(len(info_hashes)), *info_hashes, event)
+
+def unpack_publish(body):
+    # The info hashes and a view of the event
+    count, = publish_count.unpack_from(body)
+    end = publish_count.size + count * info_hash_length
+    return split_info_hashes(body[publish_count.size:end]), body[end:]
@@ -1,35 +1,273 @@
 #!/usr/bin/env python3
 
+import struct
 import asyncio
-from time import time
+import logging
+from os import getenv
+from time import time, monotonic
+from pymongo import ReturnDocument
+from pymongo.errors import CollectionInvalid, DuplicateKeyError, OperationFailure
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
 from motor.motor_asyncio import AsyncIOMotorClient
+from . import metrics
 
 EXPIRATION_INTERVAL = 2 # seconds
 
+logger = logging.getLogger(__name__)
+
+# Reads can be spread over the replica set's secondaries.
+# GET and backlog reads each take a read preference mode,
+# and reads from secondaries can be bounded to be at most
+# READ_MAX_STALENESS seconds behind (at least 90, or -1
+# for no bound). Writes always go to the primary.
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest
+}
+READ_MAX_STALENESS = int(getenv('READ_MAX_STALENESS', -1))
+
+def read_preference(mode):
+    if mode == 'primary':
+        return Primary()
+    return READ_PREFERENCES[mode](max_staleness=READ_MAX_STALENESS)
+
+GET_READ_PREFERENCE     = read_preference(getenv('GET_READ_PREFERENCE', 'primary'))
+BACKLOG_READ_PREFERENCE = read_preference(getenv('BACKLOG_READ_PREFERENCE', 'primary'))
+
+# Each link stores a revision, the editor's public key
+# packed with its counter (see write_link)
+revision_format = '!32sq'
+
+# The live links under some info hashes, as read by
+# backlogs and pages (see pubsub.py and rest.py)
+def live_links_query(info_hashes):
+    return {
+        'info_hash': { '$in': info_hashes },
+        'expiration': { '$gt': time() }
+    }
+live_links_projection = {
+    '_id': 0,
+    'editor_public_key': 1,
+    'info_hash': 1,
+    'container_signed': 1
+}
+
+# When running multiple workers (see serve.py)
+# only one of them needs to clear expired links
+def is_primary_worker():
+    return getenv('WORKER_INDEX', '0') == '0'
+
+# Writes depend on the unique index (see write_link) so it
+# is built before serving. The others only make reads and
+# expiry faster, so on a deployment that lacks them they
+# are built in the background while the service runs.
+REQUIRED_INDEXES = {
+    'editor_public_key_1': ([('editor_public_key', 1)], { 'unique': True }),
+}
+BACKGROUND_INDEXES = {
+    # Pages of an info hash's links are ordered by editor
+    'info_hash_1_editor_public_key_1': ([('info_hash', 1), ('editor_public_key', 1)], {}),
+    'expiration_1': ([('expiration', 1)], {}),
+}
+# Indexes older deployments have that something above now
+# covers. They are dropped once their replacements are built,
+# so writes stop maintaining them.
+RETIRED_INDEXES = {
+    'info_hash_1': 'info_hash_1_editor_public_key_1',
+}
+
+INDEX_NOT_FOUND = 27 # error code
+
+# What readiness reports (see health.py)
+indexes_built = False
+last_expiry = None # monotonic time of the last expiry pass
+
 async def db_intialize():
-    client = AsyncIOMotorClient('mongo')
-    if 'links' not in await client.graffiti.list_collection_names():
-        await client.graffiti.create_collection(
-            'links',
-            changeStreamPreAndPostImages={'enabled': True})
+    """
+    Make sure the collection and the indexes writes depend
+    on exist. On a deployment that has been set up before
+    this is just two quick reads.
+    """
+    client = db_client()
+    collections = await client.graffiti.list_collections(filter={ 'name': 'links' })
+    existing = await collections.to_list(None)
+    if not existing:
+        try:
+            await client.graffiti.create_collection('links')
+        except CollectionInvalid:
+            # Another worker got there first
+            pass
+    elif existing[0].get('options', {}).get('changeStreamPreAndPostImages', {}).get('enabled') \
+        and is_primary_worker():
+        # Older deployments stored pre-images for the
+        # change stream, which is no longer needed.
+        await client.graffiti.command(
+            'collMod', 'links',
+            changeStreamPreAndPostImages={'enabled': False})
 
     db = client.graffiti.links
-
-    # Create indexes if they don't already exist
-    await db.create_index('editor_public_key', unique=True)
-    await db.create_index('info_hash')
-    await db.create_index('expiration')
+    indexes = await db.index_information()
+    for name, (keys, options) in REQUIRED_INDEXES.items():
+        if name not in indexes:
+            await db.create_index(keys, name=name, **options)
+    asyncio.create_task(build_indexes(db,
+        set(BACKGROUND_INDEXES) - set(indexes),
+        set(RETIRED_INDEXES) & set(indexes)))
 
     # Start the expiration task
-    asyncio.create_task(expire())
+    if is_primary_worker():
+        asyncio.create_task(expire())
+
+async def build_indexes(db, names, retired):
+    global indexes_built
+    for name in names:
+        keys, options = BACKGROUND_INDEXES[name]
+        logger.info('building index %s', name)
+        # Creating an index that exists is a no-op, so
+        # workers racing to build one are harmless
+        while True:
+            try:
+                await db.create_index(keys, name=name, **options)
+                break
+            except Exception as e:
+                metrics.increment('db_index_build_failures')
+                logger.warning('building index %s failed: %s', name, e)
+                await asyncio.sleep(10)
+    indexes_built = True
+
+    for name in retired:
+        logger.info('dropping index %s, replaced by %s', name, RETIRED_INDEXES[name])
+        try:
+            await db.drop_index(name)
+        except OperationFailure as e:
+            # Another worker may have dropped it already
+            if e.code != INDEX_NOT_FOUND:
+                logger.warning('dropping index %s failed: %s', name, e)
+
+def accepts(existing, link):
+    # A link is only replaced if the new counter exceeds
+    # the existing counter and the new expiration equals
+    # or exceeds the existing expiration
+    return existing is None or (
+        existing['counter'] < link['counter'] and
+        existing['expiration'] <= link['expiration'])
+
+async def write_link(db, link):
+    """
+    Write a link if accepts() allows it. Returns the stored
+    link's counter, expiration and signed container as they
+    were before (or None if there was no link), which tells
+    the caller whether it was accepted.
+
+    Along with the link itself we record what the change
+    stream needs to announce it, since it only sees the
+    fields that changed (see pubsub.watch):
+    - prev_info_hash is the old info hash when this
+      update moves the link, and is removed otherwise.
+    - revision is the editor's key packed with the counter,
+      so it changes on every accepted write.
+    - any expiration tombstone (see expire) is removed.
+    """
+    editor_public_key = link['editor_public_key']
+    revision = struct.pack(revision_format, editor_public_key, link['counter'])
+
+    while True:
+        # The common case: the link exists and is replaced
+        existing = await db.find_one_and_update({
+            'editor_public_key': editor_public_key,
+            'counter': { '$lt': link['counter'] },
+            'expiration': { '$lte': link['expiration'] }
+        }, [{
+            '$set': {
+                'counter': link['counter'],
+                'expiration': link['expiration'],
+                'info_hash': link['info_hash'],
+                'container_signed': link['container_signed'],
+                'revision': revision,
+                'prev_info_hash': {
+                    '$cond': {
+                        'if': { '$ne': ['$info_hash', link['info_hash']] },
+                        'then': '$info_hash',
+                        'else': '$$REMOVE'
+                    }
+                }
+            }
+        }, {
+            '$unset': 'expired'
+        }], projection={
+            '_id': 0, 'counter': 1, 'expiration': 1, 'container_signed': 1
+        }, return_document=ReturnDocument.BEFORE)
+
+        if existing:
+            return existing
+
+        # Otherwise either there is no link yet...
+        try:
+            await db.insert_one(link | { 'revision': revision })
+            return None
+        except DuplicateKeyError:
+            pass
+
+        # ...or there is a conflicting one
+        existing = await db.find_one(
+            { 'editor_public_key': editor_public_key },
+            { '_id': 0, 'counter': 1, 'expiration': 1 })
+        if not accepts(existing, link):
+            return existing
+
+        # The stored link changed in between, so try again
 
 async def expire():
     # Every n seconds, clear expired links
+    global last_expiry
     while True:
-        await db_connection().delete_many({
-            'expiration': { '$lte': time() }
-        })
+        try:
+            await expire_once()
+            last_expiry = monotonic()
+        except Exception as e:
+            metrics.increment('expire_failures')
+            logger.warning('expiring links failed: %s', e)
         await asyncio.sleep(EXPIRATION_INTERVAL)
 
+async def expire_once():
+    now = time()
+
+    # Delete events carry nothing but the document's id,
+    # so before deleting, mark each link with a tombstone
+    # holding what the change stream needs to announce
+    # the deletion (see pubsub.watch)
+    await db_connection().update_many({
+        'expiration': { '$lte': now },
+        'expired': { '$exists': False }
+    }, [{
+        '$set': { 'expired': {
+            'editor_public_key': '$editor_public_key',
+            'info_hash': '$info_hash'
+        }}
+    }])
+
+    await db_connection().delete_many({
+        'expiration': { '$lte': now },
+        'expired': { '$exists': True }
+    })
+
+# One client, and so one connection pool, per process
+shared_client = None
+
+def db_client():
+    global shared_client
+    if shared_client is None:
+        shared_client = AsyncIOMotorClient('mongo')
+    return shared_client
+
 def db_connection():
-    return AsyncIOMotorClient('mongo').graffiti.links
\ No newline at end of file
+    return db_client().graffiti.links
+
+def db_get_connection():
+    return db_connection().with_options(read_preference=GET_READ_PREFERENCE)
+
+def db_backlog_connection():
+    return db_connection().with_options(read_preference=BACKLOG_READ_PREFERENCE)
\ No newline at end of file
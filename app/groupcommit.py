@@ -0,0 +1,107 @@
+import struct
+import asyncio
+from os import getenv
+from pymongo import UpdateOne
+from .db import db_connection, accepts, revision_format
+from . import metrics
+
+# Optionally, concurrent puts can be collected for up to
+# GROUP_COMMIT_WINDOW seconds (or GROUP_COMMIT_MAX_OPS puts)
+# and written together, trading a little latency for one
+# round trip and journal commit per batch instead of per put.
+GROUP_COMMIT         = getenv('GROUP_COMMIT') == 'true'
+GROUP_COMMIT_WINDOW  = float(getenv('GROUP_COMMIT_WINDOW', 0.002)) # seconds
+GROUP_COMMIT_MAX_OPS = int(getenv('GROUP_COMMIT_MAX_OPS', 256))
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+pending = [] # (link, future)
+timer = None
+
+def submit(link):
+    """
+    Queue a verified link for the next batch. The returned
+    future resolves to the link's document as it was before
+    this put, exactly like db.write_link, so the caller
+    can decide between success and conflict.
+    """
+    global timer
+    future = asyncio.get_running_loop().create_future()
+    pending.append((link, future))
+
+    if len(pending) >= GROUP_COMMIT_MAX_OPS:
+        flush()
+    elif timer is None:
+        timer = asyncio.get_running_loop().call_later(GROUP_COMMIT_WINDOW, flush)
+
+    return future
+
+def flush():
+    global pending, timer
+    if timer is not None:
+        timer.cancel()
+        timer = None
+    batch, pending = pending, []
+    if batch:
+        asyncio.create_task(commit(batch))
+
+async def commit(batch):
+    metrics.observe('put_batch_size', len(batch), BATCH_SIZE_BUCKETS)
+    try:
+        db = db_connection()
+        async with await db.database.client.start_session() as session:
+            results = await session.with_transaction(
+                lambda session: apply(db, session, [link for link, _ in batch]))
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+    else:
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+async def apply(db, session, links):
+    # Read every link in the batch from one snapshot...
+    keys = list({ link['editor_public_key'] for link in links })
+    before = {}
+    async for doc in db.find(
+        { 'editor_public_key': { '$in': keys } },
+        { '_id': 0, 'editor_public_key': 1, 'counter': 1,
+          'expiration': 1, 'info_hash': 1, 'container_signed': 1 },
+        session=session):
+        before[doc['editor_public_key']] = doc
+
+    # ...then play the puts in order against it, so that
+    # several puts to one key see each other's effects...
+    state = dict(before)
+    results = []
+    for link in links:
+        key = link['editor_public_key']
+        existing = state.get(key)
+        results.append(existing)
+        if accepts(existing, link):
+            state[key] = link
+
+    # ...and write each key's final state. The transaction
+    # aborts and retries if another writer got in between.
+    writes = []
+    for key, link in state.items():
+        if before.get(key) is link: continue
+
+        fields = link | { 'revision': struct.pack(revision_format, key, link['counter']) }
+        unset = { 'expired': '' }
+        old = before.get(key)
+        if old and old['info_hash'] != link['info_hash']:
+            fields['prev_info_hash'] = old['info_hash']
+        else:
+            unset['prev_info_hash'] = ''
+
+        writes.append(UpdateOne(
+            { 'editor_public_key': key },
+            { '$set': fields, '$unset': unset },
+            upsert=True))
+
+    if writes:
+        await db.bulk_write(writes, ordered=True, session=session)
+
+    return results
@@ -0,0 +1,65 @@
+import asyncio
+from os import getenv
+from time import monotonic
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from . import db
+from . import pubsub
+
+# Probes for orchestrators and load balancers. /livez
+# says the process is serving and its change stream
+# reader, which reopens the stream itself when it fails,
+# hasn't died, so it should be restarted if this fails.
+# /readyz says whether it can do its job, so whether it
+# should be sent traffic:
+# the database answers within READY_TIMEOUT seconds,
+# the change stream is open on the worker that reads it,
+# the broker is connected if there is one and, on the
+# worker that runs it, expiry has completed a pass in the
+# last EXPIRY_STALENESS seconds. Index builds that are
+# still running are reported but don't hold it up.
+# Checks that don't apply to a worker are null.
+READY_TIMEOUT    = float(getenv('READY_TIMEOUT', 1)) # seconds
+EXPIRY_STALENESS = float(getenv('EXPIRY_STALENESS', 60)) # seconds
+
+router = APIRouter()
+
+@router.get('/livez')
+async def livez():
+    watcher = pubsub.router.watcher
+    if watcher is not None and watcher.done():
+        return JSONResponse({ 'live': False }, status_code=503)
+    return { 'live': True }
+
+@router.get('/readyz')
+async def readyz():
+    checks = {
+        'database': await database_up(),
+        'change_stream': change_stream_up(),
+        'broker': pubsub.router.broker.connected,
+        'expiry': expiry_up(),
+    }
+    ready = all(up is not False for up in checks.values())
+    checks['indexes'] = db.indexes_built
+    return JSONResponse(checks | { 'ready': ready }, status_code=200 if ready else 503)
+
+async def database_up():
+    try:
+        async with asyncio.timeout(READY_TIMEOUT):
+            await db.db_client().graffiti.command('ping')
+        return True
+    except Exception:
+        return False
+
+def change_stream_up():
+    watcher = pubsub.router.watcher
+    if watcher is None:
+        return None
+    return pubsub.router.watching and not watcher.done()
+
+def expiry_up():
+    # None on workers that don't run it
+    if not db.is_primary_worker():
+        return None
+    return db.last_expiry is not None and \
+        monotonic() - db.last_expiry < EXPIRY_STALENESS
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import asyncio
 import uvicorn
 from os import getenv
 from fastapi import FastAPI
@@ -11,11 +12,17 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.responses import PlainTextResponse
 
 from .db import db_intialize
+from .serve import serve
 from . import rest
 from . import pubsub
+from . import admin
+from . import health
+from . import profiler
+from .capture import CaptureMiddleware, CAPTURE_RATE
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    asyncio.create_task(profiler.watch_loop())
     await db_intialize()
     # TODO: this is to fix a bug with lifespans
     # not working in routers yet.
@@ -27,7 +34,7 @@ app = FastAPI(lifespan=lifespan)
 
 @app.exception_handler(StarletteHTTPException)
 async def http_exception_handler(request, exc):
-    return PlainTextResponse(str(exc.detail), status_code=exc.status_code)
+    return PlainTextResponse(str(exc.detail), status_code=exc.status_code, headers=exc.headers)
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
@@ -38,10 +45,18 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["ETag", "Link"]
 )
 
-# Add rest and pubsub
+# Optionally record a sample of traffic for replay
+if CAPTURE_RATE > 0:
+    app.add_middleware(CaptureMiddleware)
+
+# Add admin, health, rest and pubsub. Health comes
+# before rest, whose /{editor_public_key} matches anything
+app.include_router(admin.router)
+app.include_router(health.router)
 app.include_router(rest.router)
 app.include_router(pubsub.router)
 
@@ -54,7 +69,7 @@ async def info():
     }
 
 if __name__ == "__main__":
-    args = {}
     if getenv('DEBUG') == 'true':
-        args['reload'] = True
-    uvicorn.run('app.main:app', host='0.0.0.0', **args)
+        uvicorn.run('app.main:app', host='0.0.0.0', reload=True)
+    else:
+        serve()
@@ -0,0 +1,62 @@
+from os import getenv
+from bisect import bisect_left
+from collections import defaultdict
+
+# A tiny in-process metrics registry rendered in the
+# Prometheus text format by the admin router. When
+# running several workers each one keeps its own
+# numbers, so every sample is labelled with the worker.
+
+DEFAULT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+counters = defaultdict(int)
+gauges = {} # name -> function returning the current value
+histograms = {} # name -> Histogram
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def increment(name, amount=1):
+    counters[name] += amount
+
+def gauge(name, function):
+    gauges[name] = function
+
+def observe(name, value, buckets=DEFAULT_BUCKETS):
+    if name not in histograms:
+        histograms[name] = Histogram(buckets)
+    histograms[name].observe(value)
+
+def render():
+    worker = getenv('WORKER_INDEX', '0')
+    label = f'worker="{worker}"'
+    lines = []
+
+    for name, value in sorted(counters.items()):
+        lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name}{{{label}}} {value}')
+
+    for name, function in sorted(gauges.items()):
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name}{{{label}}} {function()}')
+
+    for name, histogram in sorted(histograms.items()):
+        lines.append(f'# TYPE {name} histogram')
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+        lines.append(f'{name}_sum{{{label}}} {histogram.sum}')
+        lines.append(f'{name}_count{{{label}}} {histogram.count}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,200 @@
+import asyncio
+from os import getenv
+from time import monotonic
+from collections import deque
+from contextlib import asynccontextmanager
+from fastapi import HTTPException
+from pymongo.errors import ConnectionFailure, ExecutionTimeout
+from . import metrics
+
+# Keeps the service predictable when the database slows
+# down. Database operations from requests are limited to
+# a number in flight that adapts to the observed latency
+# (additive increase, multiplicative decrease). Beyond that
+# a bounded number wait in line and the rest are shed with
+# a 503. Each operation has a deadline, and if operations
+# keep failing a circuit breaker opens, failing requests
+# fast and pausing backlog loads until the database recovers.
+DB_CONCURRENCY_INITIAL = int(getenv('DB_CONCURRENCY_INITIAL', 32))
+DB_CONCURRENCY_MIN     = int(getenv('DB_CONCURRENCY_MIN', 4))
+DB_CONCURRENCY_MAX     = int(getenv('DB_CONCURRENCY_MAX', 256))
+DB_TARGET_LATENCY      = float(getenv('DB_TARGET_LATENCY', 0.05)) # seconds
+DB_QUEUE_MAX           = int(getenv('DB_QUEUE_MAX', 1024))
+DB_QUEUE_TIMEOUT       = float(getenv('DB_QUEUE_TIMEOUT', 1)) # seconds
+GET_DEADLINE           = float(getenv('GET_DEADLINE', 2)) # seconds
+PUT_DEADLINE           = float(getenv('PUT_DEADLINE', 5)) # seconds
+BACKLOG_DEADLINE       = float(getenv('BACKLOG_DEADLINE', 30)) # seconds
+BREAKER_THRESHOLD      = int(getenv('BREAKER_THRESHOLD', 5)) # consecutive failures
+BREAKER_COOLDOWN       = float(getenv('BREAKER_COOLDOWN', 5)) # seconds
+RETRY_AFTER            = 1 # seconds
+
+# Errors that mean the database is struggling
+# rather than that the request was bad
+DB_FAILURES = (asyncio.TimeoutError, ConnectionFailure, ExecutionTimeout)
+
+class Overloaded(Exception):
+    pass
+
+class AdaptiveLimiter:
+    def __init__(self, initial, minimum, maximum, target_latency, max_queue, queue_timeout):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(initial)
+        self.last_decrease = 0
+        self.target_latency = target_latency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self.waiters = deque()
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.inflight < int(self.limit) and not self.waiters:
+            self.inflight += 1
+        elif len(self.waiters) >= self.max_queue:
+            raise Overloaded()
+        else:
+            # Wait in line. Whoever wakes this waiter
+            # hands over their slot (see release)
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if not waiter.done():
+                    self.abandon(waiter)
+                    raise Overloaded()
+            except asyncio.CancelledError:
+                self.abandon(waiter)
+                raise
+
+        try:
+            yield
+        finally:
+            self.release()
+
+    def abandon(self, waiter):
+        if waiter.done():
+            # A slot was handed over just as we gave up
+            self.release()
+        else:
+            waiter.cancel()
+            self.waiters.remove(waiter)
+
+    def record(self, latency):
+        if latency > self.target_latency:
+            self.decrease(latency)
+        elif self.inflight >= int(self.limit):
+            # Only grow when the limit is what's holding us back
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def decrease(self, latency=0):
+        # Operations that were all in flight together are all
+        # slow together, so only back off once per round trip
+        now = monotonic()
+        if now - self.last_decrease >= latency:
+            self.limit = max(self.minimum, self.limit * 0.9)
+            self.last_decrease = now
+
+    def release(self):
+        # Hand the slot to the next in line, if there's room
+        self.inflight -= 1
+        while self.waiters and self.inflight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.inflight += 1
+                waiter.set_result(None)
+
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        # Once the cooldown has passed, operations are let
+        # through again ("half open") until one fails
+        return self.opened_at is not None and \
+            monotonic() - self.opened_at < self.cooldown
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if not self.is_open:
+                metrics.increment('db_breaker_trips')
+            self.opened_at = monotonic()
+
+    async def wait(self):
+        while self.is_open:
+            await asyncio.sleep(self.opened_at + self.cooldown - monotonic())
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+
+    def take(self):
+        """
+        Take a token if there is one and return 0,
+        otherwise the seconds until there will be.
+        """
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+limiter = AdaptiveLimiter(
+    DB_CONCURRENCY_INITIAL,
+    DB_CONCURRENCY_MIN,
+    DB_CONCURRENCY_MAX,
+    DB_TARGET_LATENCY,
+    DB_QUEUE_MAX,
+    DB_QUEUE_TIMEOUT)
+breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+metrics.gauge('db_concurrency_limit', lambda: int(limiter.limit))
+metrics.gauge('db_inflight', lambda: limiter.inflight)
+metrics.gauge('db_queued', lambda: len(limiter.waiters))
+metrics.gauge('db_breaker_open', lambda: int(breaker.is_open))
+
+def unavailable(detail):
+    return HTTPException(503, detail, headers={'Retry-After': str(RETRY_AFTER)})
+
+@asynccontextmanager
+async def db_operation(deadline):
+    """
+    Guards a database operation made on behalf of a
+    request, turning overload into a quick 503.
+    """
+    if breaker.is_open:
+        metrics.increment('db_shed')
+        raise unavailable('database unavailable')
+
+    try:
+        async with limiter.slot():
+            start = monotonic()
+            try:
+                async with asyncio.timeout(deadline):
+                    yield
+            except DB_FAILURES:
+                metrics.increment('db_failures')
+                limiter.decrease()
+                breaker.failure()
+                raise unavailable('database unavailable')
+            else:
+                limiter.record(monotonic() - start)
+                breaker.success()
+    except Overloaded:
+        metrics.increment('db_shed')
+        raise unavailable('server overloaded')
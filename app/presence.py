@@ -0,0 +1,104 @@
+import asyncio
+from os import getenv
+from .bloom import BloomFilter
+from .db import db_connection
+from . import metrics
+
+# An in-memory record of which info hashes might have
+# live links, so that backlog queries for info hashes
+# that certainly have none can be skipped. The filter
+# is built from the links collection and then kept up
+# to date by the change stream (see pubsub.watch).
+#
+# Expired and moved links can't be removed from a Bloom
+# filter so it is rebuilt every BLOOM_REBUILD_INTERVAL
+# seconds, or sooner if it fills past its capacity.
+BLOOM_CAPACITY         = int(getenv('BLOOM_CAPACITY', 1_000_000))
+BLOOM_ERROR_RATE       = float(getenv('BLOOM_ERROR_RATE', 0.01))
+BLOOM_REBUILD_INTERVAL = float(getenv('BLOOM_REBUILD_INTERVAL', 3600)) # seconds
+
+# Until the first build completes every
+# info hash is assumed to be present
+live = None
+building = []
+
+# The cluster time of the last change the filter has
+# seen. It is only trusted from then on: changes the
+# change stream hasn't reached yet may be missing.
+as_of = None
+# Bumped by reset so that a build that was already
+# scanning when changes were lost isn't installed
+generation = 0
+
+def add(info_hash):
+    if live is not None:
+        live.add(info_hash)
+    for bloom in building:
+        bloom.add(info_hash)
+
+def advance(cluster_time):
+    # Called with every change, after any add
+    global as_of
+    as_of = cluster_time
+
+def current(read_time):
+    # Whether the filter has seen every change up to read_time
+    return live is not None and as_of is not None and read_time is not None and as_of >= read_time
+
+def reset():
+    # The change stream skipped ahead, so changes may have
+    # been missed. Everything is assumed present again
+    # until the filter is rebuilt.
+    global live, as_of, generation
+    live = as_of = None
+    generation += 1
+
+def might_contain(info_hash):
+    return live is None or info_hash in live
+
+async def build():
+    global live
+
+    started = generation
+    capacity = BLOOM_CAPACITY
+    if live is not None:
+        capacity = max(capacity, 2 * len(live))
+    bloom = BloomFilter(capacity, BLOOM_ERROR_RATE)
+
+    # Changes that arrive during the scan are added too,
+    # so nothing committed since the scan began is missed
+    building.append(bloom)
+    try:
+        # A covered scan of the info_hash index. This
+        # includes links that have expired but not yet
+        # been deleted, which is harmless.
+        async for doc in db_connection().find(
+            {}, {'_id': 0, 'info_hash': 1}
+        ).hint('info_hash_1_editor_public_key_1'):
+            bloom.add(doc['info_hash'])
+    finally:
+        building.remove(bloom)
+
+    if generation != started:
+        return
+    live = bloom
+    metrics.increment('presence_rebuilds')
+
+async def maintain():
+    metrics.gauge('presence_keys', lambda: len(live) if live is not None else 0)
+    metrics.gauge('presence_memory_bytes', lambda: live.memory if live is not None else 0)
+    metrics.gauge('presence_false_positive_rate', lambda: live.false_positive_rate if live is not None else 1)
+
+    while True:
+        try:
+            await build()
+        except Exception:
+            metrics.increment('presence_rebuild_failures')
+            await asyncio.sleep(10)
+            continue
+
+        # Rebuild periodically, once over capacity or reset
+        waited = 0
+        while waited < BLOOM_REBUILD_INTERVAL and live is not None and len(live) < live.capacity:
+            await asyncio.sleep(10)
+            waited += 10
@@ -0,0 +1,140 @@
+import os
+import sys
+import asyncio
+import resource
+import tracemalloc
+import logging
+import threading
+import traceback
+from os import getenv
+from time import monotonic, sleep
+from collections import Counter
+from . import metrics
+
+# Tools for seeing what the event loop is doing on a live
+# instance. Both run in a separate thread and look at the
+# loop's thread from outside, so they cost the loop nothing
+# but the occasional tick.
+
+# Any callback that blocks the loop for longer than this
+# many seconds is logged along with its stack. Set to
+# zero to turn the detector off.
+SLOW_CALLBACK_THRESHOLD = float(getenv('SLOW_CALLBACK_THRESHOLD', 0.5))
+
+logger = logging.getLogger(__name__)
+
+def resident_memory():
+    # Current resident set size in bytes, or the peak
+    # where /proc isn't available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+metrics.gauge('process_resident_memory_bytes', resident_memory)
+metrics.gauge('event_loop_tasks', lambda: len(asyncio.all_tasks()))
+
+# Only one allocation trace can run at a time
+tracing = threading.Lock()
+
+async def allocations(duration, limit):
+    """
+    Trace allocations for duration seconds and return the
+    lines that hold the most memory allocated in that time
+    and not yet freed. Tracing slows everything down, so
+    it is stopped again afterwards, unless it was already
+    on (with PYTHONTRACEMALLOC, say).
+    """
+    if not tracing.acquire(blocking=False):
+        return None
+    started = not tracemalloc.is_tracing()
+    try:
+        if started:
+            tracemalloc.start()
+        await asyncio.sleep(duration)
+        stats = tracemalloc.take_snapshot().statistics('lineno')
+    finally:
+        if started:
+            tracemalloc.stop()
+        tracing.release()
+
+    return [{
+        'location': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+        'size': stat.size,
+        'count': stat.count
+    } for stat in stats[:limit]]
+
+def collapse(frame):
+    # One line of a collapsed stack, outermost call first
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+def sample(thread_id, duration, interval):
+    """
+    Sample the stack of the given thread every interval
+    seconds for duration seconds and return the samples
+    in the collapsed stack format used by flamegraph.pl
+    and speedscope.
+    """
+    stacks = Counter()
+    end = monotonic() + duration
+    while monotonic() < end:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[collapse(frame)] += 1
+        sleep(interval)
+
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+# Only one profile can run at a time
+profiling = threading.Lock()
+
+async def profile(duration, interval):
+    if not profiling.acquire(blocking=False):
+        return None
+    try:
+        return await asyncio.to_thread(sample, threading.get_ident(), duration, interval)
+    finally:
+        profiling.release()
+
+async def watch_loop():
+    """
+    Detect slow callbacks. The loop updates a timestamp
+    every half threshold and a watchdog thread checks it.
+    If the timestamp is stale, whatever is running on the
+    loop's thread is blocking it, so log its stack.
+    """
+    if not SLOW_CALLBACK_THRESHOLD: return
+
+    loop_thread = threading.get_ident()
+    last_tick = monotonic()
+    stopped = threading.Event()
+
+    def watchdog():
+        reported = None
+        while not stopped.wait(SLOW_CALLBACK_THRESHOLD / 2):
+            tick = last_tick
+            # Less the time the loop is meant to be asleep
+            blocked = monotonic() - tick - SLOW_CALLBACK_THRESHOLD / 2
+            if blocked > SLOW_CALLBACK_THRESHOLD and reported != tick:
+                # Report each stall once
+                reported = tick
+                metrics.increment('event_loop_stalls')
+                frame = sys._current_frames().get(loop_thread)
+                logger.warning(
+                    'event loop blocked for over %.3fs in:\n%s',
+                    blocked,
+                    ''.join(traceback.format_stack(frame)) if frame else '?')
+
+    threading.Thread(target=watchdog, name='slow-callback-watchdog', daemon=True).start()
+    try:
+        while True:
+            last_tick = monotonic()
+            await asyncio.sleep(SLOW_CALLBACK_THRESHOLD / 2)
+    finally:
+        stopped.set()
@@ -1,61 +1,261 @@
+import base64
+import random
 import asyncio
 import struct
-from time import time
-from enum import Enum
+import logging
+from os import getenv
+from itertools import islice
+from time import time, monotonic
+from math import ceil
 from fastapi import APIRouter, WebSocket
+from pymongo.read_preferences import Primary
+from bson.timestamp import Timestamp
 from contextlib import asynccontextmanager
-from .db import db_connection
+from .db import db_connection, db_backlog_connection, BACKLOG_READ_PREFERENCE, revision_format, live_links_query, live_links_projection, is_primary_worker
+from .codec import (
+    RequestHeader, ResponseHeader, msg_header_format, msg_header_length, heartbeat_frame,
+    unpack_request, split_info_hashes, info_hash_of, expiration_of, pack_announce,
+    pack_success, pack_error, pack_backlog_complete, pack_reconnect, pack_expired,
+    pack_event, unpack_event, unpack_announce, unpack_expired, ANNOUNCE)
+from .timerwheel import TimerWheel
+from .scheduler import FairScheduler
+from . import presence
+from . import broker
+from . import sketch
+from .overload import breaker, TokenBucket, DB_FAILURES, BACKLOG_DEADLINE
+from . import metrics
+
+# Sockets that connect with ?heartbeat=true are sent a
+# heartbeat whenever they have been quiet for
+# HEARTBEAT_INTERVAL seconds, which they answer with a
+# HEARTBEAT request. If nothing comes back within
+# IDLE_TIMEOUT seconds of the last message the socket is
+# assumed dead and reaped. Other sockets are left to the
+# server's websocket pings, since they may only listen.
+HEARTBEAT_INTERVAL = float(getenv('HEARTBEAT_INTERVAL', 30))
+IDLE_TIMEOUT       = float(getenv('IDLE_TIMEOUT', 90))
+CLOSE_TIMEOUT      = 5 # seconds
+
+# Announcements to many sockets are started
+# FANOUT_CHUNK_SIZE at a time with at most
+# FANOUT_CONCURRENCY sends in flight. Fan outs
+# to more than HOT_INFO_HASH_THRESHOLD sockets
+# are counted, and logged at most once every
+# HOT_LOG_INTERVAL seconds per info hash.
+FANOUT_CHUNK_SIZE       = int(getenv('FANOUT_CHUNK_SIZE', 256))
+FANOUT_CONCURRENCY      = int(getenv('FANOUT_CONCURRENCY', 2048))
+HOT_INFO_HASH_THRESHOLD = int(getenv('HOT_INFO_HASH_THRESHOLD', 1000))
+HOT_LOG_INTERVAL        = float(getenv('HOT_LOG_INTERVAL', 60))
+FANOUT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+# On shutdown, sockets are closed at random over
+# DRAIN_WINDOW seconds and each is told to wait a
+# random delay of up to RECONNECT_DELAY_MAX seconds
+# before reconnecting, so reconnects don't all land
+# on the next instance at once.
+DRAIN_WINDOW        = float(getenv('DRAIN_WINDOW', 10))
+RECONNECT_DELAY_MAX = float(getenv('RECONNECT_DELAY_MAX', 30))
+
+# New sockets are admitted while there are fewer than
+# MAX_SOCKETS and at no more than HANDSHAKE_RATE a
+# second, in bursts of up to HANDSHAKE_BURST. Sockets
+# turned away are closed with 1013 (try again later)
+# and told to wait a random delay before reconnecting,
+# so a reconnect storm is spread out rather than retried.
+MAX_SOCKETS     = int(getenv('MAX_SOCKETS', 100000))
+HANDSHAKE_RATE  = float(getenv('HANDSHAKE_RATE', 2000)) # per second
+HANDSHAKE_BURST = int(getenv('HANDSHAKE_BURST', 5000))
+
+# A subscribe may carry at most MAX_INFO_HASHES_PER_MESSAGE
+# info hashes and a socket may hold at most
+# MAX_INFO_HASHES_PER_SOCKET subscriptions. Backlogs are
+# read BACKLOG_CHUNK_SIZE info hashes at a time and each
+# chunk is marked complete as soon as it is done. At most
+# BACKLOG_CONCURRENCY chunks are read at once, and at most
+# BACKLOG_PARALLELISM for any one socket, with sockets
+# taking turns when chunks have to wait.
+MAX_INFO_HASHES_PER_MESSAGE = int(getenv('MAX_INFO_HASHES_PER_MESSAGE', 1024))
+MAX_INFO_HASHES_PER_SOCKET  = int(getenv('MAX_INFO_HASHES_PER_SOCKET', 16384))
+BACKLOG_CHUNK_SIZE          = int(getenv('BACKLOG_CHUNK_SIZE', 64))
+BACKLOG_CONCURRENCY         = int(getenv('BACKLOG_CONCURRENCY', 64))
+BACKLOG_PARALLELISM         = int(getenv('BACKLOG_PARALLELISM', 4))
+QUEUE_WAIT_BUCKETS = (0.001, 0.01, 0.1, 1, 10, 60)
+
+# Links expired together (by db.expire) are announced
+# together, up to EXPIRED_BATCH_MAX at a time. Sockets
+# that connect with ?batch_expired=true get them in
+# EXPIRED frames of up to EXPIRED_FRAME_MAX links,
+# others get an announcement per link as usual.
+EXPIRED_BATCH_MAX = int(getenv('EXPIRED_BATCH_MAX', 10000))
+EXPIRED_FRAME_MAX = int(getenv('EXPIRED_FRAME_MAX', 1024))
+EXPIRED_BATCH_BUCKETS = (1, 10, 100, 1000, 10000)
+
+# The change stream is reopened WATCH_RETRY_DELAY seconds
+# after failing. These errors mean it can't be resumed:
+# its history is gone (286) or it is otherwise unusable (280).
+WATCH_RETRY_DELAY = 1 # seconds
+CHANGE_STREAM_LOST = (280, 286)
+
+logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(router: APIRouter):
     router.subscriptions = {} # info_hash -> set(socket)
-    asyncio.create_task(watch())
+    router.sockets = set()
+    router.admitting = 0 # admitted sockets still being accepted
+    router.watch_time = None # cluster time of the last change announced
+    router.draining = False
+    router.hot_logged = {} # info_hash -> when its last hot fan out was logged
+    router.deadlines = TimerWheel()
+    router.backlogs = FairScheduler(BACKLOG_CONCURRENCY, BACKLOG_PARALLELISM)
+    router.handshakes = TokenBucket(HANDSHAKE_RATE, HANDSHAKE_BURST)
+    metrics.gauge('pubsub_sockets', lambda: len(router.sockets))
+    metrics.gauge('backlog_running', lambda: router.backlogs.inflight)
+    metrics.gauge('backlog_queued', lambda: router.backlogs.queued)
+    metrics.gauge('pubsub_subscribed_info_hashes', lambda: len(router.subscriptions))
+    metrics.gauge('pubsub_backlog_info_hashes', lambda: sum(len(s.backlogs) for s in router.sockets))
+    router.broker = broker.connect(deliver, reconnect_all)
+    router.watching = False # whether the change stream has opened
+    router.watcher = None
+    if broker.reads_changes(router.broker, is_primary_worker()):
+        router.watcher = asyncio.create_task(watch())
+        # Only a worker that sees every change can tell
+        # which info hashes certainly have no links
+        asyncio.create_task(presence.maintain())
+    asyncio.create_task(router.broker.run())
+    asyncio.create_task(heartbeat())
     yield
 
 router = APIRouter(lifespan=lifespan)
 
 @asynccontextmanager
 async def register(socket):
-    await socket.accept()
+    # Give up the place admission reserved once the socket
+    # holds one in router.sockets, or if it never will
+    try:
+        await socket.accept()
+    finally:
+        router.admitting -= 1
     socket.subscriptions = set()
+    socket.backlogs = {} # info_hash -> (task, info hashes it still owes)
+    socket.batch_expired = socket.query_params.get('batch_expired') == 'true'
+    socket.heartbeat = socket.query_params.get('heartbeat') == 'true'
+    router.sockets.add(socket)
+    seen(socket)
 
     try:
         yield
     finally:
+        router.sockets.discard(socket)
+        router.deadlines.cancel(socket)
         unsubscribe_all(socket)
         try:
             await socket.close()
         except: pass
-        
-msg_header_format = '!BB16s'
-msg_header_length = struct.calcsize(msg_header_format)
 
-class RequestHeader(Enum):
-    SUBSCRIBE   = 1
-    UNSUBSCRIBE = 0
+def seen(socket):
+    # Any message from the client proves it is alive
+    if socket.heartbeat:
+        socket.pinged = False
+        router.deadlines.schedule(socket, HEARTBEAT_INTERVAL)
+
+async def heartbeat():
+    while True:
+        await asyncio.sleep(router.deadlines.tick)
+        for socket in router.deadlines.advance():
+            if socket.pinged:
+                asyncio.create_task(reap(socket))
+            else:
+                socket.pinged = True
+                router.deadlines.schedule(socket, IDLE_TIMEOUT - HEARTBEAT_INTERVAL)
+                asyncio.create_task(send_heartbeat(socket))
 
-class ResponseHeader(Enum):
-    ANNOUNCE         = 0
-    SUCCESS          = 1
-    ERROR_WITH_ID    = 2
-    ERROR_WITHOUT_ID = 3
-    BACKLOG_COMPLETE = 4
+async def send_heartbeat(socket):
+    try:
+        await socket.send_bytes(heartbeat_frame)
+        metrics.increment('pubsub_heartbeats_sent')
+    except: pass
+
+async def reap(socket):
+    # Drop the subscriptions right away so the socket
+    # stops receiving announcements, then close it
+    # without waiting on a peer that may be gone.
+    router.sockets.discard(socket)
+    unsubscribe_all(socket)
+    metrics.increment('pubsub_sockets_reaped')
+    try:
+        await asyncio.wait_for(socket.close(code=1001), CLOSE_TIMEOUT)
+    except: pass
+
+async def send_reconnect(socket, delay=None):
+    # Reconnect after a delay, in milliseconds
+    if delay is None:
+        delay = random.uniform(0, RECONNECT_DELAY_MAX)
+    await socket.send_bytes(pack_reconnect(int(1000 * delay)))
+
+def admission():
+    """
+    How many seconds a new socket should wait before
+    trying again, or None if it is admitted.
+    """
+    if len(router.sockets) + router.admitting >= MAX_SOCKETS:
+        metrics.increment('pubsub_rejected_capacity')
+        return random.uniform(1, RECONNECT_DELAY_MAX)
+    if wait := router.handshakes.take():
+        metrics.increment('pubsub_rejected_rate')
+        return wait + random.uniform(0, RECONNECT_DELAY_MAX)
+    # Hold a place for it while its handshake completes
+    router.admitting += 1
+    metrics.increment('pubsub_admitted')
+    return None
+
+async def turn_away(socket, delay):
+    # Browsers can't read the frame, so the
+    # delay goes in the close reason as well
+    await socket.accept()
+    try:
+        await send_reconnect(socket, delay)
+    except: pass
+    try:
+        await socket.close(code=1013, reason=f'retry after {ceil(delay)}')
+    except: pass
+
+async def drain():
+    """
+    Called on shutdown, after the server has stopped accepting
+    connections but before it closes the ones it has.
+    """
+    router.draining = True
+    await asyncio.gather(*[
+        drain_socket(socket) for socket in router.sockets
+    ])
+
+async def drain_socket(socket):
+    await asyncio.sleep(random.uniform(0, DRAIN_WINDOW))
+    metrics.increment('pubsub_sockets_drained')
+    try:
+        await send_reconnect(socket)
+    except: pass
+    try:
+        await asyncio.wait_for(socket.close(code=1012), CLOSE_TIMEOUT)
+    except: pass
 
 async def send_error(socket: WebSocket, message, message_id=None):
-    if message_id:
-        header = struct.pack('!B16s',
-          ResponseHeader.ERROR_WITH_ID.value,
-          message_id
-        )
-    else:
-        header = struct.pack('!B',
-          ResponseHeader.ERROR_WITHOUT_ID.value
-        )
-
-    await socket.send_bytes(header + message.encode())
+    await socket.send_bytes(pack_error(message, message_id))
 
 @router.websocket("/")
 async def stream(socket: WebSocket):
+    if router.draining:
+        await socket.accept()
+        try:
+            await send_reconnect(socket)
+        except: pass
+        await socket.close(code=1012)
+        return
+
+    if (delay := admission()) is not None:
+        return await turn_away(socket, delay)
+
     async with register(socket):
         while True:
             try:
@@ -66,6 +266,8 @@ async def stream(socket: WebSocket):
             if msg["type"] != 'websocket.receive':
                 break
 
+            seen(socket)
+
             if 'bytes' not in msg:
                 try:
                     await send_error(socket, 'expecting bytes')
@@ -82,10 +284,8 @@ async def stream(socket: WebSocket):
                 except:
                     break
         
-            version, request, message_id = struct.unpack(
-                msg_header_format,
-                msg[:msg_header_length]
-            ) 
+            # The body is a view, not a copy, of the message
+            version, request, message_id, body = unpack_request(msg)
 
             if version != 0:
                 try:
@@ -94,7 +294,10 @@ async def stream(socket: WebSocket):
                 except:
                     break
 
-            body = msg[msg_header_length:]
+            # Heartbeat replies carry no body and
+            # get no reply, just being seen is enough
+            if request == RequestHeader.HEARTBEAT.value:
+                continue
 
             if not len(body):
                 try:
@@ -109,7 +312,15 @@ async def stream(socket: WebSocket):
                     continue
                 except:
                     break
-            info_hashes = [body[i:i+32] for i in range(0, len(body), 32)]
+            if len(body) > 32 * MAX_INFO_HASHES_PER_MESSAGE:
+                try:
+                    await send_error(socket, 'too many info hashes', message_id)
+                    continue
+                except:
+                    break
+            # Repeats would otherwise be read, and
+            # registered (see process_existing), twice
+            info_hashes = list(dict.fromkeys(split_info_hashes(body)))
             
             if request == RequestHeader.SUBSCRIBE.value:
                 error =   subscribe(socket, info_hashes)
@@ -126,112 +337,437 @@ async def stream(socket: WebSocket):
                 if error:
                     await send_error(socket, error, message_id)
                 else:
-                    await socket.send_bytes(struct.pack('!B16s',
-                        ResponseHeader.SUCCESS.value,
-                        message_id
-                    ))
+                    await socket.send_bytes(pack_success(message_id))
             except:
                 break
 
             # Finally, after reply is sent, process existing if necessary
-            if request == RequestHeader.SUBSCRIBE.value:
-                asyncio.create_task(process_existing(socket, info_hashes))
+            if request == RequestHeader.SUBSCRIBE.value and not error:
+                process_existing(socket, info_hashes)
 
 def subscribe(socket, info_hashes):
     # Check for double subscriptions
-    for info_hash in info_hashes:
-        if info_hash in socket.subscriptions:
-            return "already subscribed"
+    if not socket.subscriptions.isdisjoint(info_hashes):
+        return "already subscribed"
+    if len(socket.subscriptions) + len(info_hashes) > MAX_INFO_HASHES_PER_SOCKET:
+        return "too many subscriptions"
 
+    new = []
     for info_hash in info_hashes:
+        sketch.record('subscribe_info_hashes', info_hash)
         socket.subscriptions.add(info_hash)
         if info_hash not in router.subscriptions:
             router.subscriptions[info_hash] = set()
+            new.append(info_hash)
         router.subscriptions[info_hash].add(socket)
+    router.broker.subscribe(new)
 
 def unsubscribe(socket, info_hashes):
     # Check for unsubscribing non-subscribed
-    for info_hash in info_hashes:
-        if info_hash not in socket.subscriptions:
-            return "not subscribed"
+    if not socket.subscriptions.issuperset(info_hashes):
+        return "not subscribed"
 
+    gone = []
     for info_hash in info_hashes:
         if info_hash in socket.subscriptions:
             socket.subscriptions.remove(info_hash)
             router.subscriptions[info_hash].remove(socket)
             if not router.subscriptions[info_hash]:
                 del router.subscriptions[info_hash]
+                gone.append(info_hash)
+
+        # Stop reading the backlog of the info hash, and
+        # stop the read altogether once nobody wants it
+        if info_hash in socket.backlogs:
+            task, owed = socket.backlogs.pop(info_hash)
+            owed.discard(info_hash)
+            if not owed:
+                task.cancel()
+    router.broker.unsubscribe(gone)
 
 def unsubscribe_all(socket):
     return unsubscribe(socket, socket.subscriptions.copy())
 
 async def announce(socket, editor_public_key, prev_info_hash, container_signed):
-    await socket.send_bytes(struct.pack('!B32s32s',
-        ResponseHeader.ANNOUNCE.value,
-        editor_public_key,
-        prev_info_hash
-    ) + container_signed)
-
-async def process_existing(socket, info_hashes):
-    async for doc in db_connection().find({
-        "info_hash": { "$in": info_hashes},
-        "expiration": { "$gt": time() }
-    }):
-        try:
-            await announce(socket, doc['editor_public_key'], doc['info_hash'], doc['container_signed'])
-        except:
+    await socket.send_bytes(pack_announce(editor_public_key, prev_info_hash, container_signed))
+
+@asynccontextmanager
+async def backlog_session():
+    """
+    The socket is subscribed before its backlog is read, so
+    any change that watch hasn't announced yet will reach it
+    live. Everything watch has already announced must then
+    be in the backlog, which a lagging secondary might not
+    have. So backlog reads from secondaries wait until they
+    have caught up to the last change watch announced, and
+    go to the primary until watch has started.
+    """
+    if isinstance(BACKLOG_READ_PREFERENCE, Primary) or router.watch_time is None:
+        yield None
+    else:
+        client = db_connection().database.client
+        async with await client.start_session(causal_consistency=True) as session:
+            session.advance_operation_time(router.watch_time)
+            yield session
+
+def process_existing(socket, info_hashes):
+    # Big subscriptions are read in bounded chunks so no one
+    # query holds a huge $in open and the client hears about
+    # each chunk as soon as it's done. Each chunk's task is
+    # registered under its info hashes so unsubscribing can
+    # cancel it (see unsubscribe).
+    for i in range(0, len(info_hashes), BACKLOG_CHUNK_SIZE):
+        chunk = info_hashes[i:i+BACKLOG_CHUNK_SIZE]
+        owed = set(chunk)
+        task = asyncio.create_task(scheduled(socket, chunk, owed))
+        for info_hash in owed:
+            socket.backlogs[info_hash] = (task, owed)
+
+async def scheduled(socket, info_hashes, owed):
+    # Chunks from every socket share the scheduler, so a
+    # socket subscribing to a few info hashes isn't stuck
+    # behind one subscribing to many.
+    try:
+        await caught_up(info_hashes)
+        async with router.backlogs.slot(socket) as wait:
+            metrics.observe('backlog_queue_wait_seconds', wait, QUEUE_WAIT_BUCKETS)
+            await process_chunk(socket, info_hashes, owed)
+    except asyncio.CancelledError:
+        metrics.increment('backlog_chunks_cancelled')
+        raise
+    finally:
+        for info_hash in owed:
+            if socket.backlogs.get(info_hash, (None,))[0] is asyncio.current_task():
+                del socket.backlogs[info_hash]
+
+async def caught_up(info_hashes):
+    # Changes to the info hashes must be on their way here
+    # before the backlog is read, and the backlog must hold
+    # any published before then (see broker.RemoteBroker)
+    position = await router.broker.ready(info_hashes)
+    if position is not None:
+        position = Timestamp(*position)
+        if router.watch_time is None or position > router.watch_time:
+            router.watch_time = position
+
+async def process_chunk(socket, info_hashes, owed):
+    # Only query for info hashes that might have links, and
+    # only trust the filter once it has seen every change
+    # announced before now: those the socket won't hear live
+    candidates = info_hashes
+    if presence.current(router.watch_time):
+        candidates = [h for h in info_hashes if presence.might_contain(h)]
+    metrics.increment('backlog_info_hashes', len(info_hashes))
+    metrics.increment('backlog_info_hashes_skipped', len(info_hashes) - len(candidates))
+
+    if candidates:
+        found = False
+        while True:
+            # Hold off while the database is unhealthy
+            await breaker.wait()
+            try:
+                async with backlog_session() as session:
+                    db = db_backlog_connection() if session else db_connection()
+                    cursor = db.find(
+                        live_links_query(candidates),
+                        live_links_projection,
+                        session=session
+                    ).max_time_ms(int(1000 * BACKLOG_DEADLINE))
+                    try:
+                        async for doc in cursor:
+                            found = True
+                            if doc['info_hash'] not in owed:
+                                # Unsubscribed while reading
+                                metrics.increment('backlog_wasted_reads')
+                                continue
+                            try:
+                                await announce(socket, doc['editor_public_key'], doc['info_hash'], doc['container_signed'])
+                            except Exception:
+                                # Not cancellation, which must
+                                # reach scheduled (see unsubscribe)
+                                break
+                    finally:
+                        # Free the server side cursor right away
+                        # rather than when it times out
+                        await cursor.close()
+            except DB_FAILURES:
+                # Try again once the database recovers, as
+                # long as the socket is still around
+                metrics.increment('db_failures')
+                breaker.failure()
+                if socket in router.sockets:
+                    continue
+                return
+            breaker.success()
             break
 
+        if not found:
+            metrics.increment('backlog_queries_empty')
+    else:
+        metrics.increment('backlog_queries_skipped')
+
+    # Send a message that marks the backlog of
+    # these info hashes (those still subscribed)
+    # as complete, if any are
+    complete = [h for h in info_hashes if h in owed]
+    if not complete: return
     try:
-        # Send a message that marks the backlog
-        # of these info hashes as complete
-        await socket.send_bytes(struct.pack('!B',
-            ResponseHeader.BACKLOG_COMPLETE.value,
-        ) + b''.join(info_hashes))
+        await socket.send_bytes(pack_backlog_complete(complete))
     except Exception as e:
         pass
 
 async def watch():
-    async with db_connection().watch(
-        [{'$match' : {}}], # Match all
-        full_document='whenAvailable',
-        full_document_before_change='whenAvailable'
-    ) as stream:
-
-        async for change in stream:
-
-            socket_union = set()
-            container_signed = b''
-            editor_public_key = None
-            prev_info_hash = None
-
-            for doc_state in ['fullDocumentBeforeChange', 'fullDocument']:
-                if doc_state in change:
-                    doc = change[doc_state]
-
-                    info_hash = doc['info_hash']
-                    if doc_state == 'fullDocumentBeforeChange' or not prev_info_hash:
-                        prev_info_hash = info_hash
-
-                    editor_public_key = doc['editor_public_key']
-
-                    if doc_state == 'fullDocument' and doc['expiration'] > time():
-                        container_signed = doc['container_signed']
-                    
-                    # Get all the sockets subscibed to the
-                    # new and old info hash, if they exist
-                    if info_hash in router.subscriptions:
-                        socket_union = socket_union.union(router.subscriptions[info_hash])
-
-            if not editor_public_key: continue
-                
-            # Send the new document to all relevant info hashes.
-            tasks = [announce(
-                socket,
-                editor_public_key,
-                prev_info_hash,
-                container_signed
-            ) for socket in socket_union]
-
-            # Send the changes (ignoring failed sends)
-            await asyncio.gather(*tasks, return_exceptions=True)
\ No newline at end of file
+    """
+    Read the change stream for as long as the worker runs.
+    If it fails, in a stepdown say, it is reopened after the
+    last change published. If it was gone so long that the
+    oplog no longer reaches back that far, it starts again
+    from now and every socket reconnects, which reads the
+    backlogs of whatever was missed.
+    """
+    router.resume_token = None
+    start_time = None
+    while True:
+        try:
+            if router.resume_token is not None:
+                await read_changes({ 'resume_after': router.resume_token })
+            else:
+                if start_time is None:
+                    # The stream starts from a known cluster time so
+                    # that backlog reads can be made consistent with it.
+                    start = await db_connection().database.command('ping')
+                    start_time = router.watch_time = start['operationTime']
+                await read_changes({ 'start_at_operation_time': start_time })
+        except Exception as e:
+            router.watching = False
+            metrics.increment('change_stream_failures')
+            logger.warning('change stream failed: %s', e)
+            if getattr(e, 'code', None) in CHANGE_STREAM_LOST:
+                router.resume_token = start_time = None
+                presence.reset()
+                reconnect_all()
+            await asyncio.sleep(WATCH_RETRY_DELAY)
+
+async def read_changes(position):
+    # Links no longer store pre-images, so everything
+    # needed to announce a change comes from inserted
+    # documents and the fields recorded alongside each
+    # update by rest.put and db.expire.
+    async with db_connection().watch([{
+        '$match': { '$or': [
+            { 'operationType': 'insert' },
+            { 'updateDescription.updatedFields.revision': { '$exists': True } },
+            { 'updateDescription.updatedFields.expired': { '$exists': True } }
+        ]}
+    }, {
+        '$project': {
+            'operationType': 1,
+            'clusterTime': 1,
+            'fullDocument.editor_public_key': 1,
+            'fullDocument.info_hash': 1,
+            'fullDocument.container_signed': 1,
+            'updateDescription.updatedFields.revision': 1,
+            'updateDescription.updatedFields.prev_info_hash': 1,
+            'updateDescription.updatedFields.container_signed': 1,
+            'updateDescription.updatedFields.expired': 1
+        }
+    }], **position) as stream:
+        router.watching = True
+
+        # Tombstones from one run of db.expire arrive back to
+        # back, so they are collected for as long as they keep
+        # coming without waiting, and announced together
+        # before anything that follows them.
+        expired = [] # (editor_public_key, info_hash)
+        while True:
+            change = await (stream.try_next() if expired else stream.next())
+
+            if expired and (change is None or len(expired) >= EXPIRED_BATCH_MAX or not tombstone(change)):
+                await router.broker.publish(
+                    list(dict.fromkeys(info_hash for _, info_hash in expired)),
+                    pack_change(expired_time, pack_expired(expired)))
+                router.resume_token = expired_token
+                expired = []
+            if change is None: continue
+
+            if link := tombstone(change):
+                # The link has expired and is about to be deleted
+                expired.append((link['editor_public_key'], link['info_hash']))
+                expired_time = change['clusterTime']
+                presence.advance(expired_time)
+                expired_token = change['_id']
+                continue
+
+            if change['operationType'] == 'insert':
+                doc = change['fullDocument']
+                editor_public_key = doc['editor_public_key']
+                container_signed  = doc['container_signed']
+                info_hash = prev_info_hash = doc['info_hash']
+            else:
+                fields = change['updateDescription']['updatedFields']
+                editor_public_key, _ = struct.unpack(revision_format, fields['revision'])
+                container_signed = fields['container_signed']
+                info_hash = info_hash_of(container_signed)
+                # This is only present if the link moved
+                prev_info_hash = fields.get('prev_info_hash', info_hash)
+
+            if container_signed:
+                presence.add(info_hash)
+                if expiration_of(container_signed) <= time():
+                    container_signed = b''
+            presence.advance(change['clusterTime'])
+
+            # Under both the new and old info hashes
+            await router.broker.publish(
+                list(dict.fromkeys([prev_info_hash, info_hash])),
+                pack_change(change['clusterTime'], pack_announce(editor_public_key, prev_info_hash, container_signed)))
+            router.resume_token = change['_id']
+
+def pack_change(cluster_time, frame):
+    return pack_event(cluster_time.time, cluster_time.inc, frame)
+
+async def deliver(event):
+    """
+    Announce a change published by watch (see broker.py)
+    to the sockets here that are subscribed to it.
+    """
+    seconds, increment, frame = unpack_event(event)
+    cluster_time = Timestamp(seconds, increment)
+
+    if frame[0] == ANNOUNCE:
+        editor_public_key, prev_info_hash, container_signed = unpack_announce(frame)
+        prev_info_hash = prev_info_hash.tobytes()
+        info_hash = info_hash_of(container_signed) if container_signed else prev_info_hash
+
+        # Send the new document to all the sockets
+        # subscribed to the new and old info hashes.
+        # Sockets that subscribe from here on will
+        # find this change in their backlog instead.
+        router.watch_time = cluster_time
+        await fan_out(subscribers(dict.fromkeys([prev_info_hash, info_hash])), frame)
+    else:
+        await announce_expired([
+            (editor_public_key.tobytes(), info_hash.tobytes())
+            for editor_public_key, info_hash in unpack_expired(frame)])
+        router.watch_time = cluster_time
+
+def reconnect_all():
+    # Changes may have been missed while the broker was
+    # away, so every socket reconnects, which reads its
+    # backlogs again, over the next DRAIN_WINDOW seconds
+    metrics.increment('pubsub_broker_losses')
+    for socket in list(router.sockets):
+        asyncio.create_task(drain_socket(socket))
+
+def subscribers(info_hashes):
+    """
+    Iterate over every socket subscribed to any of
+    the info hashes exactly once. Only the sockets
+    ahead of the last group are gathered into a set.
+    """
+    groups = []
+    for info_hash in info_hashes:
+        if info_hash in router.subscriptions:
+            # Snapshot the set since fan out yields to the
+            # loop and (un)subscribes may change it meanwhile
+            group = tuple(router.subscriptions[info_hash])
+            groups.append(group)
+            sketch.record('fanout_info_hashes', info_hash, len(group))
+
+    total = sum(len(sockets) for sockets in groups)
+    metrics.observe('pubsub_fanout_size', total, FANOUT_BUCKETS)
+    if total >= HOT_INFO_HASH_THRESHOLD:
+        metrics.increment('pubsub_hot_fanouts')
+        log_hot(info_hashes, total)
+
+    # Duplicates are judged against the snapshots, not the
+    # live sets, which may have changed since they were taken
+    earlier = set()
+    for i, sockets in enumerate(groups):
+        for socket in sockets:
+            if socket not in earlier:
+                yield socket
+        if i < len(groups) - 1:
+            earlier.update(sockets)
+
+def log_hot(info_hashes, total):
+    # A hot info hash may fan out many times a second,
+    # so each is only logged once per HOT_LOG_INTERVAL
+    now = monotonic()
+    if any(now - router.hot_logged.get(h, -HOT_LOG_INTERVAL) >= HOT_LOG_INTERVAL for h in info_hashes):
+        router.hot_logged = { h: t for h, t in router.hot_logged.items() if now - t < HOT_LOG_INTERVAL }
+        router.hot_logged.update(dict.fromkeys(info_hashes, now))
+        logger.warning(
+            'hot fan out to %d sockets for info hash(es) %s',
+            total,
+            ', '.join(base64.urlsafe_b64encode(h).decode() for h in info_hashes))
+
+def tombstone(change):
+    # What db.expire recorded, if that's what this change is
+    return change.get('updateDescription', {}).get('updatedFields', {}).get('expired')
+
+async def announce_expired(expired):
+    """
+    Gather the subscribers of every info hash in the batch
+    once, then send each socket everything it needs.
+    """
+    metrics.increment('pubsub_expired_batches')
+    metrics.observe('pubsub_expired_batch_size', len(expired), EXPIRED_BATCH_BUCKETS)
+
+    by_info_hash = {}
+    for editor_public_key, info_hash in expired:
+        by_info_hash.setdefault(info_hash, []).append(editor_public_key)
+
+    # Nothing yields while this is built, so
+    # the subscriber sets needn't be copied
+    by_socket = {}
+    for info_hash, editors in by_info_hash.items():
+        for socket in router.subscriptions.get(info_hash, ()):
+            by_socket.setdefault(socket, []).append(info_hash)
+    metrics.observe('pubsub_fanout_size', len(by_socket), FANOUT_BUCKETS)
+
+    announcements = {} # info_hash -> frames, built once each
+    def messages():
+        for socket, info_hashes in by_socket.items():
+            if socket.batch_expired:
+                links = [(editor_public_key, info_hash)
+                    for info_hash in info_hashes
+                    for editor_public_key in by_info_hash[info_hash]]
+                for i in range(0, len(links), EXPIRED_FRAME_MAX):
+                    yield socket, pack_expired(links[i:i+EXPIRED_FRAME_MAX])
+            else:
+                for info_hash in info_hashes:
+                    if info_hash not in announcements:
+                        announcements[info_hash] = [pack_announce(editor_public_key, info_hash, b'')
+                            for editor_public_key in by_info_hash[info_hash]]
+                    for announcement in announcements[info_hash]:
+                        yield socket, announcement
+
+    await fan_out_messages(messages())
+
+async def send(socket, message):
+    try:
+        await socket.send_bytes(message)
+    except: pass
+
+async def fan_out(sockets, message):
+    await fan_out_messages((socket, message) for socket in sockets)
+
+async def fan_out_messages(messages):
+    # Sends are started a chunk at a time, yielding to the
+    # loop between chunks so that other coroutines aren't
+    # starved, with a cap on how many are in flight at once.
+    pending = set()
+    while True:
+        chunk = list(islice(messages, FANOUT_CHUNK_SIZE))
+        if not chunk: break
+
+        for socket, message in chunk:
+            pending.add(asyncio.create_task(send(socket, message)))
+
+        while len(pending) >= FANOUT_CONCURRENCY:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        await asyncio.sleep(0)
+
+    if pending:
+        await asyncio.wait(pending)
@@ -1,10 +1,15 @@
-import struct
 import base64
+from os import getenv
 from time import time
+from hashlib import blake2b
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
 from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
-from .db import db_connection
+from .db import db_connection, db_get_connection, db_backlog_connection, write_link, live_links_query, live_links_projection
+from . import groupcommit
+from . import sketch
+from .overload import db_operation, GET_DEADLINE, PUT_DEADLINE
+from .codec import put_metadata_length, signature_length, payload_max_length, unpack_container, pack_record
 
 class ByteResponse(Response):
     media_type = "application/octet-stream"
@@ -13,68 +18,137 @@ class ByteResponse(Response):
 
 router = APIRouter()
 
-def decode_editor_public_key(editor_public_key_base64):
-    # Convert the editor public key to bytes
+# Pages of the links under an info hash hold at most
+# PAGE_MAX_LIMIT links and may be cached by proxies
+# for PAGE_MAX_AGE seconds.
+PAGE_DEFAULT_LIMIT = 100
+PAGE_MAX_LIMIT     = int(getenv('PAGE_MAX_LIMIT', 1000))
+PAGE_MAX_AGE       = int(getenv('PAGE_MAX_AGE', 5)) # seconds
+
+def decode_key(key_base64, name):
+    # Convert the key to bytes
     try:
-        editor_public_key = base64.urlsafe_b64decode(editor_public_key_base64)
+        key = base64.urlsafe_b64decode(key_base64)
     except Exception as e:
-        raise HTTPException(422, 'public key is not correctly base 64 encoded')
+        raise HTTPException(422, f'{name} is not correctly base 64 encoded')
 
     # and make sure it is a 32 byte Ed25519 public key
-    if len(editor_public_key) != 32:
-        raise HTTPException(422, 'public key must be exactly 32 bytes long')
+    if len(key) != 32:
+        raise HTTPException(422, f'{name} must be exactly 32 bytes long')
+
+    return key
+
+def decode_editor_public_key(editor_public_key_base64):
+    return decode_key(editor_public_key_base64, 'public key')
+
+def decode_info_hash(info_hash_base64):
+    return decode_key(info_hash_base64, 'info hash')
 
-    return editor_public_key
+@router.get('/info_hash/{info_hash_base64}')
+async def get_page(
+    request: Request,
+    info_hash: bytes = Depends(decode_info_hash),
+    after: str = None,
+    limit: int = PAGE_DEFAULT_LIMIT):
+    """
+    A page of the live links under an info hash, as
+    records ordered by editor public key. If there may
+    be more, a Link header points to the next page,
+    which starts after the last editor on this one.
+    """
+    if not 0 < limit <= PAGE_MAX_LIMIT:
+        raise HTTPException(422, f'limit must be between 1 and {PAGE_MAX_LIMIT}')
+
+    query = live_links_query([info_hash])
+    if after is not None:
+        query['editor_public_key'] = { '$gt': decode_key(after, 'after') }
+
+    # No presence shortcut: the filter lags the change stream
+    # and, unlike a backlog, a page has no stream to make up
+    # for a link it missed, so it would be cached empty
+    async with db_operation(GET_DEADLINE):
+        docs = await db_backlog_connection().find(
+            query, live_links_projection
+        ).sort('editor_public_key', 1).limit(limit + 1).to_list(None)
+
+    headers = { 'Cache-Control': f'public, max-age={PAGE_MAX_AGE}' }
+    if len(docs) > limit:
+        docs = docs[:limit]
+        after = base64.urlsafe_b64encode(docs[-1]['editor_public_key']).decode()
+        headers['Link'] = f'<{request.url.path}?after={after}&limit={limit}>; rel="next"'
+
+    content = b''.join(pack_record(doc['editor_public_key'], doc['container_signed']) for doc in docs)
+    etag = '"' + base64.urlsafe_b64encode(blake2b(content, digest_size=16).digest()).decode() + '"'
+    headers['ETag'] = etag
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+
+    return ByteResponse(content, headers=headers)
 
 @router.get('/{editor_public_key_base64}')
 async def get(
     editor_public_key: bytes = Depends(decode_editor_public_key),
-    db=Depends(db_connection)):
+    db=Depends(db_get_connection)):
 
-    result = await db.find_one({
-        "editor_public_key": editor_public_key,
-        "expiration": { '$gt': time() }
-    })
+    sketch.record('get_editor_public_keys', editor_public_key)
+
+    async with db_operation(GET_DEADLINE):
+        result = await db.find_one({
+            "editor_public_key": editor_public_key,
+            "expiration": { '$gt': time() }
+        })
 
     if result:
         return ByteResponse(result['container_signed'])
     else:
         raise HTTPException(404, 'link not found')
 
-put_metadata_format = '!B32s64sqq'
-put_metadata_length = struct.calcsize(put_metadata_format)
-signature_length = 64
-payload_max_length = 256
-
 @router.put('/{editor_public_key_base64}')
 async def put(
     request: Request,
     editor_public_key: bytes = Depends(decode_editor_public_key),
     db=Depends(db_connection)):
 
+    sketch.record('put_editor_public_keys', editor_public_key)
+
     # Get the body as raw bytes
     container_signed: bytes = await request.body()
+    link = verify_link(editor_public_key, container_signed)
+
+    async with db_operation(PUT_DEADLINE):
+        if groupcommit.GROUP_COMMIT:
+            # Batched with other concurrent puts,
+            # with the same outcome
+            existing = await groupcommit.submit(link)
+        else:
+            existing = await write_link(db, link)
+
+    if existing:
+        if existing['counter'] >= link['counter']:
+            raise HTTPException(409, 'counter must increase')
+        elif existing['expiration'] > link['expiration']:
+            raise HTTPException(409, 'expiration cannot decrease')
+        else:
+            return ByteResponse(existing['container_signed'])
+    else:
+        return ByteResponse(None)
+
+def verify_link(editor_public_key, container_signed):
+    """
+    Check a signed container put by the editor and
+    unpack it into the link to store. Shared with
+    bulk imports (see transfer.py).
+    """
     if len(container_signed) < put_metadata_length + signature_length:
         raise HTTPException(422, "not enough data")
     if len(container_signed) > put_metadata_length + signature_length + payload_max_length:
         raise HTTPException(413, 'payload cannot exceed 256 bytes')
 
-    # Unpack the metadata from the block of the container...
-
-    # The 64 byte Ed25519 signature is at the end
-    container, signature = container_signed[:-signature_length], container_signed[-signature_length:]
-
-    # A bunch of data is packed into the beginning:
-    # version:             2 byte unsigned short
-    # info_hash:          32 byte Ed25519 public key
-    # proof_of_knowledge: 64 byte Ed25519 signature
-    # counter              8 byte signed long long
-    # expiration           8 byte signed long long
-    version, info_hash, proof_of_knowledge, counter, expiration\
-    = struct.unpack(
-        put_metadata_format,
-        container[:put_metadata_length]
-    )
+    # Unpack the metadata from the beginning of the container,
+    # along with the signed part and the signature at the end
+    # (see codec.py)
+    version, info_hash, proof_of_knowledge, counter, expiration, container, signature\
+    = unpack_container(container_signed)
 
     if version > 0:
         raise HTTPException(400, 'this is version zero')
@@ -82,9 +156,6 @@ async def put(
     if expiration <= time():
         raise HTTPException(400, 'data has already expired')
 
-    # The payload is the middle rest of the container
-    payload = container[put_metadata_length:]
-
     # Verify the editor's signature
     editor_public_key_obj = Ed25519PublicKey.from_public_bytes(editor_public_key)
     try:
@@ -110,48 +181,11 @@ async def put(
     # We will update the link, only if the provided counter
     # exceeds the existing counter (if one exists), and
     # if the provided expiration equals or exceeds the
-    # existing expiration.
-    #
-    # Because of the way mongo works, this condition needs to
-    # be copied over multiple times, so here is a helper function
-    # for it.
-    def conditional_field(name, variable):
-        return {
-            name: {
-                "$cond": {
-                    "if": {
-                        "$and": [{
-                            # The old counter is less than the new
-                            "$lt": ["$counter", counter]
-                        }, {
-                            # The old expiration is less than
-                            # or equal to the new
-                            "$lte": ["$expiration", expiration]
-                        }]
-                    },
-                    "then": variable,
-                    "else": f"${name}"
-                },
-            }
-        }
-
-    # Apply the mongo update
-    existing = await db.find_one_and_update({
+    # existing expiration (see db.write_link).
+    return {
         "editor_public_key": editor_public_key,
-    }, [{
-        "$set": { "editor_public_key": editor_public_key } |
-        conditional_field("counter", counter) |
-        conditional_field("expiration", expiration) |
-        conditional_field("info_hash", info_hash) |
-        conditional_field("container_signed", container_signed)
-    }], upsert=True)
-
-    if existing:
-        if existing['counter'] >= counter:
-            raise HTTPException(409, 'counter must increase')
-        elif existing['expiration'] > expiration:
-            raise HTTPException(409, 'expiration cannot decrease')
-        else:
-            return ByteResponse(existing['container_signed'])
-    else:
-        return ByteResponse(None)
\ No newline at end of file
+        "counter": counter,
+        "expiration": expiration,
+        "info_hash": info_hash,
+        "container_signed": container_signed
+    }
\ No newline at end of file
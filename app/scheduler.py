@@ -0,0 +1,96 @@
+import asyncio
+from time import monotonic
+from collections import deque
+from contextlib import asynccontextmanager
+
+class FairScheduler:
+    """
+    Limits how many jobs run at once, and at most per_owner
+    for any one owner. Jobs that have to wait are let through
+    taking turns between owners, so an owner with a long line
+    of jobs can't hold up owners with only a few.
+    """
+
+    def __init__(self, concurrency, per_owner):
+        self.concurrency = concurrency
+        self.per_owner = per_owner
+        self.inflight = 0
+        self.running = {} # owner -> number of jobs running
+        self.queues = {} # owner -> deque(waiter)
+        self.turns = deque() # owners with jobs waiting, in turn order
+
+    @asynccontextmanager
+    async def slot(self, owner):
+        """
+        Wait for a turn and yield how many seconds it took.
+        """
+        start = monotonic()
+        if self.inflight < self.concurrency and \
+            self.running.get(owner, 0) < self.per_owner and \
+            owner not in self.queues:
+            self.acquire(owner)
+        else:
+            # Wait in line. Whoever wakes this waiter
+            # hands over their slot (see dispatch)
+            waiter = asyncio.get_running_loop().create_future()
+            if owner not in self.queues:
+                self.queues[owner] = deque()
+                self.turns.append(owner)
+            self.queues[owner].append(waiter)
+            try:
+                await asyncio.shield(waiter)
+            except asyncio.CancelledError:
+                self.abandon(owner, waiter)
+                raise
+
+        try:
+            yield monotonic() - start
+        finally:
+            self.release(owner)
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def acquire(self, owner):
+        self.inflight += 1
+        self.running[owner] = self.running.get(owner, 0) + 1
+
+    def abandon(self, owner, waiter):
+        if waiter.done():
+            # A slot was handed over just as we gave up
+            self.release(owner)
+        else:
+            waiter.cancel()
+            queue = self.queues[owner]
+            queue.remove(waiter)
+            if not queue:
+                del self.queues[owner]
+                self.turns.remove(owner)
+
+    def release(self, owner):
+        self.inflight -= 1
+        self.running[owner] -= 1
+        if not self.running[owner]:
+            del self.running[owner]
+        self.dispatch()
+
+    def dispatch(self):
+        # Go round the owners in line handing out one slot
+        # each, skipping any already running their share
+        skipped = 0
+        while self.inflight < self.concurrency and skipped < len(self.turns):
+            owner = self.turns.popleft()
+            if self.running.get(owner, 0) >= self.per_owner:
+                self.turns.append(owner)
+                skipped += 1
+                continue
+
+            queue = self.queues[owner]
+            self.acquire(owner)
+            queue.popleft().set_result(None)
+            if queue:
+                self.turns.append(owner)
+            else:
+                del self.queues[owner]
+            skipped = 0
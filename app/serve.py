@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import signal
+import uvicorn
+import multiprocessing
+from time import sleep
+from os import getenv
+from . import pubsub
+
+# Production launcher. Each worker is a full copy
+# of the app with its own event loop, sockets and
+# change stream. TCP workers each bind their own
+# SO_REUSEPORT socket so the kernel spreads incoming
+# connections across them. A unix socket can't be
+# load balanced that way so it is bound once here
+# and inherited by every worker.
+
+WORKERS     = int(getenv('WORKERS', os.cpu_count() or 1))
+HOST        = getenv('HOST', '0.0.0.0')
+PORT        = int(getenv('PORT', 8000))
+UNIX_SOCKET = getenv('UNIX_SOCKET')
+BACKLOG     = 2048
+
+def bind_tcp(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+def bind_unix(path):
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    # nginx runs as a different user
+    os.chmod(path, 0o666)
+    sock.listen(BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+class DrainingServer(uvicorn.Server):
+    async def shutdown(self, sockets=None):
+        # Stop accepting connections, then let pubsub close
+        # its sockets gradually while requests in flight
+        # finish, before uvicorn closes everything else.
+        for server in self.servers:
+            server.close()
+        for sock in sockets or []:
+            sock.close()
+        await pubsub.drain()
+        await super().shutdown(sockets)
+
+def run_worker(index, sock=None):
+    # Background work that must only happen once
+    # per deployment (like expiring links) is
+    # assigned to worker zero. See db.py
+    os.environ['WORKER_INDEX'] = str(index)
+
+    if sock is None:
+        sock = bind_tcp(HOST, PORT)
+
+    config = uvicorn.Config(
+        'app.main:app',
+        loop='uvloop',
+        http='httptools',
+        ws='websockets',
+        backlog=BACKLOG,
+        proxy_headers=True,
+        forwarded_allow_ips='*')
+    DrainingServer(config).run(sockets=[sock])
+
+def serve():
+    context = multiprocessing.get_context('spawn')
+    shared_sock = bind_unix(UNIX_SOCKET) if UNIX_SOCKET else None
+
+    def start(index):
+        process = context.Process(
+            target=run_worker,
+            args=(index, shared_sock),
+            name=f'graffiti-worker-{index}')
+        process.start()
+        return process
+
+    workers = [start(i) for i in range(WORKERS)]
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Restart any worker that dies so that
+    # worker zero's duties are never dropped
+    while not stopping:
+        for i, process in enumerate(workers):
+            if not process.is_alive() and not stopping:
+                workers[i] = start(i)
+        sleep(1)
+
+    for process in workers:
+        if process.is_alive():
+            process.terminate()
+    for process in workers:
+        process.join()
+
+    if UNIX_SOCKET and os.path.exists(UNIX_SOCKET):
+        os.remove(UNIX_SOCKET)
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,83 @@
+from os import getenv, urandom
+from time import monotonic
+from array import array
+from hashlib import blake2b
+
+# Streaming top-K tracking of the busiest keys, such as
+# the info hashes that drive fan out or the editor keys
+# that drive puts, in fixed memory however many keys
+# there are. Counts are halved every SKETCH_DECAY_INTERVAL
+# seconds so the rankings follow current traffic.
+SKETCH_WIDTH          = int(getenv('SKETCH_WIDTH', 4096))
+SKETCH_DEPTH          = int(getenv('SKETCH_DEPTH', 4))
+SKETCH_TOP_K          = int(getenv('SKETCH_TOP_K', 100))
+SKETCH_DECAY_INTERVAL = float(getenv('SKETCH_DECAY_INTERVAL', 300)) # seconds
+
+class HeavyHitters:
+    """
+    A count-min sketch estimates how often each key has been
+    seen (never under, sometimes over) and the k keys with
+    the highest estimates are kept alongside it.
+    """
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, k=SKETCH_TOP_K, decay_interval=SKETCH_DECAY_INTERVAL):
+        self.width = width
+        self.depth = depth
+        self.k = k
+        self.rows = [array('Q', bytes(8 * width)) for _ in range(depth)]
+        self.top = {} # key -> estimate
+        self.floor = 0 # at most the smallest estimate in top
+        self.salt = urandom(16)
+        self.decay_interval = decay_interval
+        self.last_decay = monotonic()
+
+    def indices(self, key):
+        digest = blake2b(key, digest_size=4 * self.depth, key=self.salt).digest()
+        for i in range(self.depth):
+            yield int.from_bytes(digest[4*i:4*i+4], 'little') % self.width
+
+    def add(self, key, weight=1):
+        if self.decay_interval and monotonic() - self.last_decay > self.decay_interval:
+            self.decay()
+
+        estimate = None
+        for row, index in zip(self.rows, self.indices(key)):
+            row[index] += weight
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+
+        if key in self.top or len(self.top) < self.k:
+            self.top[key] = estimate
+        elif estimate > self.floor:
+            # The floor only rises as estimates grow, so
+            # the true minimum may need to be found first
+            smallest = min(self.top, key=self.top.get)
+            if estimate > self.top[smallest]:
+                del self.top[smallest]
+                self.top[key] = estimate
+            self.floor = min(self.top.values())
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.rows, self.indices(key)))
+
+    def decay(self):
+        for row in self.rows:
+            for i in range(self.width):
+                row[i] >>= 1
+        self.top = { key: count >> 1 for key, count in self.top.items() if count > 1 }
+        self.floor = min(self.top.values(), default=0)
+        self.last_decay = monotonic()
+
+    def most_common(self, n=None):
+        return sorted(self.top.items(), key=lambda item: item[1], reverse=True)[:n]
+
+    @property
+    def memory(self):
+        return sum(row.itemsize * len(row) for row in self.rows)
+
+sketches = {} # name -> HeavyHitters
+
+def record(name, key, weight=1):
+    if name not in sketches:
+        sketches[name] = HeavyHitters()
+    sketches[name].add(key, weight)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import unittest
+from random import randbytes
+from ..bloom import BloomFilter
+
+class TestBloom(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        keys = [randbytes(32) for _ in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        for key in keys:
+            self.assertIn(key, bloom)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for _ in range(1000):
+            bloom.add(randbytes(32))
+        false_positives = sum(randbytes(32) in bloom for _ in range(10000))
+        self.assertLess(false_positives / 10000, 0.03)
+        self.assertAlmostEqual(bloom.false_positive_rate, 0.01, delta=0.005)
+
+    def test_repeated_adds(self):
+        bloom = BloomFilter(1000)
+        key = randbytes(32)
+        for _ in range(10):
+            bloom.add(key)
+        self.assertEqual(len(bloom), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import asyncio
+import unittest
+from random import randbytes
+from .. import broker
+from ..codec import pack_event, unpack_event, pack_announce
+
+class TestBroker(unittest.IsolatedAsyncioTestCase):
+    # Workers talk to a broker run here, in process
+
+    async def asyncSetUp(self):
+        self.server = await broker.serve('127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.workers = []
+        self.received = []
+        self.losses = 0
+        for _ in range(2):
+            received = []
+            self.received.append(received)
+            worker = broker.RemoteBroker(self.deliver(received), self.lost, f'127.0.0.1:{port}')
+            worker.task = asyncio.create_task(worker.run())
+            self.workers.append(worker)
+        while not all(worker.connected for worker in self.workers):
+            await asyncio.sleep(0.01)
+
+    async def asyncTearDown(self):
+        for worker in self.workers:
+            worker.task.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def deliver(self, received):
+        async def deliver(event):
+            received.append(unpack_event(event))
+        return deliver
+
+    def lost(self):
+        self.losses += 1
+
+    async def settle(self):
+        await asyncio.sleep(0.05)
+
+    async def test_routes_by_info_hash(self):
+        reader, other = self.workers
+        info_hash, elsewhere = randbytes(32), randbytes(32)
+        other.subscribe([info_hash])
+        self.assertIsNone(await other.ready([info_hash]))
+
+        frame = pack_announce(randbytes(32), info_hash, randbytes(100))
+        await reader.publish([info_hash], pack_event(10, 1, frame))
+        await reader.publish([elsewhere], pack_event(10, 2, frame))
+        await self.settle()
+
+        self.assertEqual(self.received[1], [(10, 1, frame)])
+        # Publishers only get what they subscribe to
+        self.assertEqual(self.received[0], [])
+
+    async def test_delivered_once(self):
+        reader, other = self.workers
+        prev_info_hash, info_hash = randbytes(32), randbytes(32)
+        other.subscribe([prev_info_hash, info_hash])
+        await other.ready([prev_info_hash, info_hash])
+
+        frame = pack_announce(randbytes(32), prev_info_hash, randbytes(100))
+        await reader.publish([prev_info_hash, info_hash], pack_event(1, 1, frame))
+        await self.settle()
+        self.assertEqual(len(self.received[1]), 1)
+
+    async def test_subscribed_position(self):
+        reader, other = self.workers
+        info_hash = randbytes(32)
+        await reader.publish([randbytes(32)], pack_event(20, 5, b'\x00'))
+        await self.settle()
+
+        # Backlogs catch up to what was published before
+        other.subscribe([info_hash])
+        self.assertEqual(await other.ready([info_hash]), (20, 5))
+        # and once subscribed there's nothing to wait for
+        self.assertIsNone(await other.ready([info_hash]))
+
+    async def test_unsubscribe(self):
+        reader, other = self.workers
+        info_hash = randbytes(32)
+        other.subscribe([info_hash])
+        await other.ready([info_hash])
+        other.unsubscribe([info_hash])
+        await self.settle()
+
+        await reader.publish([info_hash], pack_event(1, 1, b'\x00'))
+        await self.settle()
+        self.assertEqual(self.received[1], [])
+
+    async def test_resubscribes_after_losing_the_broker(self):
+        reader, other = self.workers
+        info_hash = randbytes(32)
+        other.subscribe([info_hash])
+        await other.ready([info_hash])
+
+        other.writer.transport.abort()
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.losses, 1)
+        while not other.connected:
+            await asyncio.sleep(0.01)
+        await other.ready([info_hash])
+
+        await reader.publish([info_hash], pack_event(1, 1, b'\x00'))
+        await self.settle()
+        self.assertEqual(self.received[1], [(1, 1, b'\x00')])
+
+    async def test_losing_a_publisher_drops_everyone(self):
+        reader, other = self.workers
+        info_hash = randbytes(32)
+        other.subscribe([info_hash])
+        await other.ready([info_hash])
+        await reader.publish([info_hash], pack_event(1, 1, b'\x00'))
+        await self.settle()
+
+        # Events it had sent may be lost with it, so
+        # subscribers must read their backlogs again
+        reader.writer.transport.abort()
+        await self.settle()
+        self.assertEqual(self.losses, 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import asyncio
+import unittest
+from time import time
+from random import randbytes
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from ..client import LinkClient, Editor, LinkServiceError
+from .utils import URL_BASE
+
+class TestClient(unittest.IsolatedAsyncioTestCase):
+
+    async def test_put_get(self):
+        async with LinkClient(URL_BASE) as client:
+            editor = Editor()
+            info_hash, pok = editor.prove(Ed25519PrivateKey.generate())
+            expiration = int(time()) + 100
+
+            first = editor.sign(info_hash, pok, 0, expiration, randbytes(16))
+            self.assertIsNone(await client.put(editor, first))
+            self.assertEqual(await client.get(editor.public_key), first)
+
+            second = editor.sign(info_hash, pok, 1, expiration, randbytes(16))
+            self.assertEqual(await client.put(editor, second), first)
+
+            with self.assertRaises(LinkServiceError):
+                await client.put(editor, first)
+
+            self.assertEqual([record async for record in client.links(info_hash)],
+                [(editor.public_key, second)])
+
+    async def test_stream(self):
+        async with LinkClient(URL_BASE) as client:
+            announced = asyncio.Queue()
+            completed = asyncio.Queue()
+            stream = await client.stream(
+                on_announce=lambda a: announced.put_nowait(
+                    (bytes(a.editor_public_key), bytes(a.info_hash))),
+                on_backlog_complete=lambda info_hashes: completed.put_nowait(
+                    [bytes(h) for h in info_hashes]))
+
+            editor = Editor()
+            info_hash, pok = editor.prove(Ed25519PrivateKey.generate())
+            others = [randbytes(32) for _ in range(10)]
+
+            # Pipelined subscribes
+            await asyncio.gather(stream.subscribe([info_hash]), stream.subscribe(others))
+            backlogs = [await completed.get(), await completed.get()]
+            self.assertCountEqual(backlogs, [[info_hash], others])
+
+            await client.put(editor, editor.sign(info_hash, pok, 0, int(time()) + 100, b''))
+            self.assertEqual(await announced.get(), (editor.public_key, info_hash))
+
+            # Drop the socket; the stream reconnects and
+            # subscribes to everything again, so the
+            # backlog is replayed
+            await stream.ws.close()
+            self.assertCountEqual(await completed.get(), others + [info_hash])
+            self.assertEqual(await announced.get(), (editor.public_key, info_hash))
+
+            # and new puts are announced
+            await client.put(editor, editor.sign(info_hash, pok, 1, int(time()) + 100, b''))
+            self.assertEqual(await announced.get(), (editor.public_key, info_hash))
+
+            await stream.close()
+
+if __name__ == "__main__":
+    unittest.main()
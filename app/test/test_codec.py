@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import unittest
+from random import randbytes
+from .. import codec
+from ..codec import RequestHeader, ResponseHeader
+
+class TestCodec(unittest.TestCase):
+
+    def test_container(self):
+        info_hash, pok, signature = randbytes(32), randbytes(64), randbytes(64)
+        container_signed = codec.pack_container(0, info_hash, pok, 7, 1234, b'payload') + signature
+
+        version, unpacked_info_hash, unpacked_pok, counter, expiration, container, unpacked_signature \
+            = codec.unpack_container(container_signed)
+        self.assertEqual((version, unpacked_info_hash, unpacked_pok, counter, expiration),
+            (0, info_hash, pok, 7, 1234))
+        self.assertEqual(container, container_signed[:-64])
+        self.assertEqual(unpacked_signature, signature)
+        self.assertIsInstance(container, memoryview)
+
+        self.assertEqual(codec.info_hash_of(container_signed), info_hash)
+        self.assertEqual(codec.expiration_of(container_signed), 1234)
+
+    def test_request(self):
+        message_id = randbytes(16)
+        info_hashes = [randbytes(32) for _ in range(3)]
+        msg = codec.pack_request(RequestHeader.SUBSCRIBE, message_id, info_hashes)
+
+        version, request, unpacked_message_id, body = codec.unpack_request(msg)
+        self.assertEqual((version, request, unpacked_message_id),
+            (0, RequestHeader.SUBSCRIBE.value, message_id))
+        self.assertEqual(codec.split_info_hashes(body), info_hashes)
+
+    def test_responses(self):
+        editor_public_key, prev_info_hash, container_signed = randbytes(32), randbytes(32), randbytes(200)
+        frame = codec.pack_announce(editor_public_key, prev_info_hash, container_signed)
+        self.assertEqual(frame[0], ResponseHeader.ANNOUNCE.value)
+        self.assertEqual(codec.unpack_announce(frame), (editor_public_key, prev_info_hash, container_signed))
+
+        info_hashes = [randbytes(32) for _ in range(3)]
+        frame = codec.pack_backlog_complete(info_hashes)
+        self.assertEqual(frame[0], ResponseHeader.BACKLOG_COMPLETE.value)
+        self.assertEqual(codec.unpack_backlog_complete(frame), info_hashes)
+
+        links = [(randbytes(32), randbytes(32)) for _ in range(3)]
+        frame = codec.pack_expired(links)
+        self.assertEqual(frame[0], ResponseHeader.EXPIRED.value)
+        self.assertEqual(codec.unpack_expired(frame), links)
+
+        message_id = randbytes(16)
+        self.assertEqual(codec.response_message_id(codec.pack_success(message_id)), message_id)
+        self.assertEqual(codec.pack_error('oops', message_id)[17:], b'oops')
+        self.assertEqual(codec.pack_error('oops'), bytes((ResponseHeader.ERROR_WITHOUT_ID.value,)) + b'oops')
+        self.assertEqual(codec.unpack_reconnect(codec.pack_reconnect(1500)), 1500)
+
+    def test_records(self):
+        links = [(randbytes(32), randbytes(100 + i)) for i in range(3)]
+        stream = b''.join(codec.pack_record(*link) for link in links)
+
+        # Records split across chunks are left for the next one
+        buffer = bytearray(stream[:-10])
+        records, used = codec.unpack_records(buffer)
+        self.assertEqual(records, links[:2])
+        del buffer[:used]
+        buffer += stream[-10:]
+        records, used = codec.unpack_records(buffer)
+        self.assertEqual(records, links[2:])
+        self.assertEqual(used, len(buffer))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import struct
+import unittest
+from random import randbytes
+from pymongo import UpdateOne
+from ..groupcommit import apply
+from ..db import revision_format
+
+class Collection:
+    # Just enough of a collection for apply: the
+    # documents it finds and the writes it is given
+    def __init__(self, docs=()):
+        self.docs = { doc['editor_public_key']: doc for doc in docs }
+        self.writes = []
+
+    async def find(self, query, projection, session=None):
+        for key in query['editor_public_key']['$in']:
+            if key in self.docs:
+                yield self.docs[key]
+
+    async def bulk_write(self, writes, ordered=True, session=None):
+        self.writes += writes
+
+def link(editor_public_key, counter, expiration=100, info_hash=None):
+    return {
+        'editor_public_key': editor_public_key,
+        'counter': counter,
+        'expiration': expiration,
+        'info_hash': info_hash or b'i' * 32,
+        'container_signed': randbytes(16)
+    }
+
+def write(link, set_prev=None):
+    key = link['editor_public_key']
+    fields = link | { 'revision': struct.pack(revision_format, key, link['counter']) }
+    unset = { 'expired': '' }
+    if set_prev:
+        fields['prev_info_hash'] = set_prev
+    else:
+        unset['prev_info_hash'] = ''
+    return UpdateOne({ 'editor_public_key': key }, { '$set': fields, '$unset': unset }, upsert=True)
+
+class TestGroupCommit(unittest.IsolatedAsyncioTestCase):
+
+    async def test_conflicts_within_a_batch(self):
+        key = randbytes(32)
+        stored = link(key, 1)
+        db = Collection([stored])
+
+        newer = link(key, 3)
+        older = link(key, 2) # counter must increase
+        shorter = link(key, 4, expiration=50) # expiration cannot decrease
+        results = await apply(db, None, [newer, older, shorter])
+
+        # Each put sees the ones before it, as rest.put
+        # would have: the first replaces the stored link
+        # and the others conflict with the first
+        self.assertEqual(results, [stored, newer, newer])
+        self.assertEqual(db.writes, [write(newer)])
+
+    async def test_several_accepted_in_a_batch(self):
+        key = randbytes(32)
+        first, second = link(key, 1), link(key, 2)
+        db = Collection()
+        results = await apply(db, None, [first, second])
+
+        self.assertEqual(results, [None, first])
+        # Only the final state is written
+        self.assertEqual(db.writes, [write(second)])
+
+    async def test_upsert(self):
+        new = link(randbytes(32), 0)
+        db = Collection()
+        self.assertEqual(await apply(db, None, [new]), [None])
+        self.assertEqual(db.writes, [write(new)])
+
+    async def test_move(self):
+        key = randbytes(32)
+        stored = link(key, 1, info_hash=b'a' * 32)
+        moved = link(key, 2, info_hash=b'b' * 32)
+        db = Collection([stored])
+        self.assertEqual(await apply(db, None, [moved]), [stored])
+        self.assertEqual(db.writes, [write(moved, set_prev=b'a' * 32)])
+
+    async def test_move_and_back(self):
+        # Moving away and back within a batch is no move at all
+        key = randbytes(32)
+        stored = link(key, 1, info_hash=b'a' * 32)
+        away = link(key, 2, info_hash=b'b' * 32)
+        back = link(key, 3, info_hash=b'a' * 32)
+        db = Collection([stored])
+        self.assertEqual(await apply(db, None, [away, back]), [stored, away])
+        self.assertEqual(db.writes, [write(back)])
+
+    async def test_nothing_accepted(self):
+        key = randbytes(32)
+        stored = link(key, 5)
+        db = Collection([stored])
+        self.assertEqual(await apply(db, None, [link(key, 5)]), [stored])
+        self.assertEqual(db.writes, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+import unittest
+import aiohttp
+from .utils import URL_BASE
+
+class TestHealth(unittest.IsolatedAsyncioTestCase):
+
+    async def test_livez(self):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(URL_BASE + 'livez') as response:
+                self.assertEqual(response.status, 200)
+                self.assertEqual(await response.json(), { 'live': True })
+
+    async def test_readyz(self):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(URL_BASE + 'readyz') as response:
+                self.assertEqual(response.status, 200)
+                checks = await response.json()
+                self.assertTrue(checks['ready'])
+                self.assertTrue(checks['database'])
+                # Without a broker every worker reads the change stream
+                self.assertTrue(checks['change_stream'])
+                self.assertIsNone(checks['broker'])
+                # Only the first worker expires links
+                self.assertIn(checks['expiry'], (True, None))
+
+if __name__ == "__main__":
+    unittest.main()
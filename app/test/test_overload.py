@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import asyncio
+import unittest
+from ..overload import AdaptiveLimiter, CircuitBreaker, TokenBucket, Overloaded
+
+class TestOverload(unittest.IsolatedAsyncioTestCase):
+
+    async def test_limiter_queues_then_sheds(self):
+        limiter = AdaptiveLimiter(2, 1, 4, 1, max_queue=1, queue_timeout=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with limiter.slot():
+                await release.wait()
+
+        holders = [asyncio.create_task(hold()) for _ in range(3)]
+        await asyncio.sleep(0)
+        self.assertEqual(limiter.inflight, 2)
+        self.assertEqual(len(limiter.waiters), 1)
+
+        # The queue is full
+        with self.assertRaises(Overloaded):
+            async with limiter.slot(): pass
+
+        release.set()
+        await asyncio.gather(*holders)
+        self.assertEqual(limiter.inflight, 0)
+
+    async def test_limiter_queue_timeout(self):
+        limiter = AdaptiveLimiter(1, 1, 4, 1, max_queue=10, queue_timeout=0.05)
+        async with limiter.slot():
+            with self.assertRaises(Overloaded):
+                async with limiter.slot(): pass
+        self.assertEqual(limiter.inflight, 0)
+        self.assertEqual(len(limiter.waiters), 0)
+
+    async def test_limiter_adapts(self):
+        limiter = AdaptiveLimiter(10, 2, 20, target_latency=0.1, max_queue=10, queue_timeout=1)
+        limiter.record(1)
+        self.assertLess(limiter.limit, 10)
+        limiter.decrease()
+        self.assertGreaterEqual(limiter.limit, 2)
+
+    async def test_breaker(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+        breaker.failure()
+        self.assertFalse(breaker.is_open)
+        breaker.failure()
+        self.assertTrue(breaker.is_open)
+        await breaker.wait()
+        self.assertFalse(breaker.is_open)
+        breaker.success()
+        self.assertEqual(breaker.failures, 0)
+
+    async def test_token_bucket(self):
+        bucket = TokenBucket(rate=100, burst=3)
+        self.assertEqual([bucket.take() for _ in range(3)], [0, 0, 0])
+        wait = bucket.take()
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.01)
+        await asyncio.sleep(0.02)
+        self.assertEqual(bucket.take(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
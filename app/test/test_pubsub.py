@@ -2,10 +2,11 @@
 
 import unittest
 import aiohttp
-from ..pubsub import msg_header_format, RequestHeader, ResponseHeader
+from ..pubsub import msg_header_format, RequestHeader, ResponseHeader, MAX_INFO_HASHES_PER_MESSAGE, BACKLOG_CHUNK_SIZE
 import struct
+import asyncio
 from random import randbytes
-from .utils import socket_connection, response_header_byte
+from .utils import socket_connection, response_header_byte, put_simple, subscribe_uris
 
 class TestPubSub(unittest.IsolatedAsyncioTestCase):
 
@@ -177,6 +178,118 @@ class TestPubSub(unittest.IsolatedAsyncioTestCase):
                 b'not subscribed'
             )
 
+    async def test_heartbeat_no_reply(self):
+        async with socket_connection() as ws:
+            await ws.send_bytes(struct.pack(
+                msg_header_format,
+                0,
+                RequestHeader.HEARTBEAT.value,
+                randbytes(16)
+            ))
+
+            # The heartbeat gets no reply so the next
+            # message is the reply to the unsubscribe
+            message_id = randbytes(16)
+            await ws.send_bytes(struct.pack(
+                msg_header_format,
+                0,
+                RequestHeader.UNSUBSCRIBE.value,
+                message_id
+            ) + randbytes(32))
+
+            reply = await ws.receive()
+            self.assertEqual(reply.type, aiohttp.WSMsgType.binary)
+            self.assertEqual(reply.data,
+                response_header_byte('ERROR_WITH_ID') +
+                message_id +
+                b'not subscribed'
+            )
+
+    async def test_too_many_info_hashes(self):
+        async with socket_connection() as ws:
+            message_id = randbytes(16)
+            await ws.send_bytes(struct.pack(
+                msg_header_format,
+                0,
+                RequestHeader.SUBSCRIBE.value,
+                message_id
+            ) + randbytes(32 * (MAX_INFO_HASHES_PER_MESSAGE + 1)))
+
+            reply = await ws.receive()
+            self.assertEqual(reply.type, aiohttp.WSMsgType.binary)
+            self.assertEqual(reply.data,
+                response_header_byte('ERROR_WITH_ID') +
+                message_id +
+                b'too many info hashes'
+            )
+
+    async def test_chunked_backlog(self):
+        async with socket_connection() as ws:
+            info_hashes = [randbytes(32) for _ in range(3 * BACKLOG_CHUNK_SIZE + 1)]
+            message_id = randbytes(16)
+            await ws.send_bytes(struct.pack(
+                msg_header_format,
+                0,
+                RequestHeader.SUBSCRIBE.value,
+                message_id
+            ) + b''.join(info_hashes))
+
+            reply = await ws.receive()
+            self.assertEqual(reply.data, response_header_byte('SUCCESS') + message_id)
+
+            # Each chunk is completed separately,
+            # in whatever order they finish
+            completed = []
+            while len(completed) < len(info_hashes):
+                reply = await ws.receive_bytes()
+                self.assertEqual(reply[:1], response_header_byte('BACKLOG_COMPLETE'))
+                chunk = [reply[i:i+32] for i in range(1, len(reply), 32)]
+                self.assertLessEqual(len(chunk), BACKLOG_CHUNK_SIZE)
+                completed += chunk
+            self.assertCountEqual(completed, info_hashes)
+
+    async def test_unsubscribe_during_backlog(self):
+        _, _, info_hash, uri_private_key, _ = await put_simple()
+        for _ in range(49):
+            await put_simple(uri_private_key=uri_private_key)
+
+        async with socket_connection() as ws:
+            subscribe_id = await subscribe_uris(ws, [info_hash])
+            unsubscribe_id = await subscribe_uris(ws, [info_hash], unsubscribe=True)
+
+            # The backlog may get partway before the unsubscribe
+            while True:
+                reply = await ws.receive_bytes()
+                if reply == response_header_byte('SUCCESS') + unsubscribe_id:
+                    break
+                self.assertIn(reply[:1], [
+                    response_header_byte('SUCCESS'),
+                    response_header_byte('ANNOUNCE'),
+                    response_header_byte('BACKLOG_COMPLETE')])
+
+            # but nothing follows it
+            with self.assertRaises(asyncio.TimeoutError):
+                await ws.receive(timeout=1)
+
+    async def test_repeated_info_hashes(self):
+        async with socket_connection() as ws:
+            info_hashes = [randbytes(32) for _ in range(BACKLOG_CHUNK_SIZE)]
+            # The repeats land in another chunk
+            message_id = await subscribe_uris(ws, info_hashes + info_hashes[:2])
+            reply = await ws.receive_bytes()
+            self.assertEqual(reply, response_header_byte('SUCCESS') + message_id)
+
+            completed = []
+            while len(completed) < len(info_hashes):
+                reply = await ws.receive_bytes()
+                self.assertEqual(reply[:1], response_header_byte('BACKLOG_COMPLETE'))
+                completed += [reply[i:i+32] for i in range(1, len(reply), 32)]
+            self.assertCountEqual(completed, info_hashes)
+
+            message_id = await subscribe_uris(ws, info_hashes, unsubscribe=True)
+            reply = await ws.receive_bytes()
+            self.assertEqual(reply, response_header_byte('SUCCESS') + message_id)
+
     async def test_close(self):
         async with socket_connection() as ws:
             await ws.close()
@@ -6,7 +6,8 @@ import time
 from random import randbytes
 import base64
 import asyncio
-from .utils import URL_BASE, editor_public_private_keys, generate_info_hash_and_pok, put
+from .utils import URL_BASE, editor_public_private_keys, generate_info_hash_and_pok, put, put_simple
+from ..codec import unpack_records
 
 class TestRest(unittest.IsolatedAsyncioTestCase):
     
@@ -402,5 +403,45 @@ class TestRest(unittest.IsolatedAsyncioTestCase):
                 self.assertEqual(response.status, 404)
                 self.assertEqual(await response.read(), b'link not found')
 
+    async def test_page(self):
+        # Several editors link to the same info hash
+        _, _, info_hash, uri_private_key, container_signed = await put_simple()
+        links = { }
+        for _ in range(4):
+            editor_public_key, _, _, _, container_signed = await put_simple(uri_private_key=uri_private_key)
+            links[editor_public_key] = container_signed
+
+        info_hash_base64 = base64.urlsafe_b64encode(info_hash).decode()
+        url = f'{URL_BASE}info_hash/{info_hash_base64}?limit=2'
+        found = []
+        async with aiohttp.ClientSession() as session:
+            while url:
+                async with session.get(url) as response:
+                    self.assertEqual(response.status, 200)
+                    records, used = unpack_records(await response.read())
+                    self.assertLessEqual(len(records), 2)
+                    found += records
+                    next_page = response.links.get('next')
+                    url = str(response.url.join(next_page['url'])) if next_page else None
+
+            # Pages are ordered by editor and cover every link
+            editors = [editor_public_key for editor_public_key, _ in found]
+            self.assertEqual(editors, sorted(editors))
+            self.assertEqual(len(found), 5)
+            for editor_public_key, container_signed in links.items():
+                self.assertIn((editor_public_key, container_signed), found)
+
+            # Unchanged pages aren't sent again
+            url = f'{URL_BASE}info_hash/{info_hash_base64}'
+            async with session.get(url) as response:
+                etag = response.headers['ETag']
+            async with session.get(url, headers={ 'If-None-Match': etag }) as response:
+                self.assertEqual(response.status, 304)
+
+    async def test_page_bad_info_hash(self):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f'{URL_BASE}info_hash/asdf') as response:
+                self.assertEqual(response.status, 422)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
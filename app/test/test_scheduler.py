@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import asyncio
+import unittest
+from ..scheduler import FairScheduler
+
+class TestScheduler(unittest.IsolatedAsyncioTestCase):
+
+    async def test_takes_turns(self):
+        scheduler = FairScheduler(concurrency=1, per_owner=1)
+        order = []
+        release = asyncio.Event()
+
+        async def job(owner, name):
+            async with scheduler.slot(owner):
+                order.append(name)
+                await release.wait()
+
+        # Big queues up lots of work before small arrives
+        tasks = [asyncio.create_task(job('big', f'big{i}')) for i in range(4)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(job('small', 'small')))
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.inflight, 1)
+        self.assertEqual(scheduler.queued, 4)
+
+        release.set()
+        await asyncio.gather(*tasks)
+        # Small only waits for big's next turn, not all of them
+        self.assertEqual(order, ['big0', 'big1', 'small', 'big2', 'big3'])
+        self.assertEqual(scheduler.inflight, 0)
+        self.assertEqual(scheduler.queued, 0)
+
+    async def test_per_owner_limit(self):
+        scheduler = FairScheduler(concurrency=4, per_owner=2)
+        release = asyncio.Event()
+
+        async def job(owner):
+            async with scheduler.slot(owner):
+                await release.wait()
+
+        tasks = [asyncio.create_task(job('a')) for _ in range(3)]
+        tasks.append(asyncio.create_task(job('b')))
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.running, { 'a': 2, 'b': 1 })
+        self.assertEqual(scheduler.queued, 1)
+
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(scheduler.running, {})
+
+    async def test_cancel_waiting(self):
+        scheduler = FairScheduler(concurrency=1, per_owner=1)
+        async with scheduler.slot('a'):
+            waiting = asyncio.create_task(scheduler.slot('b').__aenter__())
+            await asyncio.sleep(0)
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+            self.assertEqual(scheduler.queued, 0)
+            self.assertEqual(len(scheduler.turns), 0)
+        self.assertEqual(scheduler.inflight, 0)
+
+    async def test_reports_wait(self):
+        scheduler = FairScheduler(concurrency=1, per_owner=1)
+        async with scheduler.slot('a') as wait:
+            self.assertLess(wait, 0.01)
+
+if __name__ == "__main__":
+    unittest.main()
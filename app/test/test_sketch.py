@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+import unittest
+from random import randbytes
+from ..sketch import HeavyHitters
+
+class TestSketch(unittest.TestCase):
+
+    def test_finds_heavy_hitters(self):
+        hitters = HeavyHitters(width=1024, depth=4, k=10, decay_interval=0)
+        heavy = [randbytes(32) for _ in range(5)]
+        for i in range(20000):
+            hitters.add(heavy[i % 5] if i % 4 == 0 else randbytes(32))
+
+        top = [key for key, _ in hitters.most_common(5)]
+        self.assertEqual(set(top), set(heavy))
+
+    def test_never_underestimates(self):
+        hitters = HeavyHitters(width=64, depth=2, k=5, decay_interval=0)
+        key = randbytes(32)
+        hitters.add(key, 7)
+        for _ in range(1000):
+            hitters.add(randbytes(32))
+        self.assertGreaterEqual(hitters.estimate(key), 7)
+
+    def test_decay(self):
+        hitters = HeavyHitters(width=64, depth=2, k=5, decay_interval=0)
+        key = randbytes(32)
+        hitters.add(key, 8)
+        hitters.decay()
+        self.assertEqual(hitters.most_common(), [(key, 4)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import unittest
+from ..timerwheel import TimerWheel
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_expires_in_order(self):
+        wheel = TimerWheel(tick=1, slots=8)
+        start = wheel.last_tick
+        wheel.schedule('a', 1)
+        wheel.schedule('b', 3)
+        self.assertEqual(wheel.advance(start + 1), ['a'])
+        self.assertEqual(wheel.advance(start + 2), [])
+        self.assertEqual(wheel.advance(start + 3), ['b'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_longer_than_a_turn(self):
+        wheel = TimerWheel(tick=1, slots=4)
+        start = wheel.last_tick
+        wheel.schedule('a', 4)
+        wheel.schedule('b', 10)
+        self.assertEqual(wheel.advance(start + 3), [])
+        self.assertEqual(wheel.advance(start + 4), ['a'])
+        self.assertEqual(wheel.advance(start + 9), [])
+        self.assertEqual(wheel.advance(start + 10), ['b'])
+
+    def test_reschedule_and_cancel(self):
+        wheel = TimerWheel(tick=1, slots=8)
+        start = wheel.last_tick
+        wheel.schedule('a', 2)
+        wheel.schedule('b', 2)
+        wheel.schedule('a', 5)
+        wheel.cancel('b')
+        self.assertNotIn('b', wheel)
+        self.assertEqual(wheel.advance(start + 4), [])
+        self.assertEqual(wheel.advance(start + 5), ['a'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,8 @@
-import struct
 import aiohttp
 import base64
 from time import time
 from random import randbytes
-from ..rest import put_metadata_format
-from ..pubsub import RequestHeader, ResponseHeader, msg_header_format
+from ..codec import RequestHeader, ResponseHeader, pack_container, pack_request
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from contextlib import asynccontextmanager
 
@@ -31,12 +29,7 @@ async def put(
     expiration,
     payload
 ):
-    container = struct.pack(put_metadata_format,
-        version,
-        info_hash,
-        pok, counter,
-        expiration
-    ) + payload
+    container = pack_container(version, info_hash, pok, counter, expiration, payload)
 
     container_signed = container + editor_private_key.sign(container)
 
@@ -82,23 +75,18 @@ async def put_simple(
     return editor_public_key, editor_private_key, info_hash, uri_private_key, container_signed
 
 @asynccontextmanager
-async def socket_connection():
+async def socket_connection(params=None):
     async with aiohttp.ClientSession() as session:
-        async with session.ws_connect(URL_BASE) as ws:
+        async with session.ws_connect(URL_BASE, params=params) as ws:
             yield ws
 
 async def subscribe_uris(ws, info_hashes, unsubscribe=False):
     request = RequestHeader.SUBSCRIBE if not unsubscribe else RequestHeader.UNSUBSCRIBE
 
     message_id = randbytes(16)
-    await ws.send_bytes(struct.pack(
-        msg_header_format,
-        0,
-        request.value,
-        message_id
-    ) + b''.join(info_hashes))
+    await ws.send_bytes(pack_request(request, message_id, info_hashes))
 
     return message_id
 
 def response_header_byte(name):
-    return struct.pack('!B', ResponseHeader[name].value)
+    return bytes((ResponseHeader[name].value,))
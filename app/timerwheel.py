@@ -0,0 +1,64 @@
+from time import monotonic
+
+class TimerWheel:
+    """
+    A hashed timer wheel. Scheduling, rescheduling and
+    cancelling a key are all O(1), and each tick only
+    looks at the keys in a single slot, so tracking
+    deadlines for every open socket doesn't need a
+    task or a heap entry per socket.
+
+    Deadlines are rounded up to the next tick. Delays
+    longer than a full turn of the wheel are handled by
+    counting how many turns remain.
+    """
+
+    def __init__(self, tick=1., slots=512):
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)] # key -> turns remaining
+        self.location = {} # key -> slot index
+        self.position = 0
+        self.last_tick = monotonic()
+
+    def __len__(self):
+        return len(self.location)
+
+    def __contains__(self, key):
+        return key in self.location
+
+    def schedule(self, key, delay):
+        self.cancel(key)
+        ticks = max(1, -int(-delay // self.tick))
+        turns, offset = divmod(ticks, len(self.slots))
+        # Landing exactly a full turn away is the
+        # current slot, which has already been visited
+        if offset == 0:
+            turns -= 1
+        index = (self.position + offset) % len(self.slots)
+        self.slots[index][key] = turns
+        self.location[key] = index
+
+    def cancel(self, key):
+        index = self.location.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self, now=None):
+        """
+        Move the wheel forward to the present and
+        return all the keys whose deadline has passed.
+        """
+        now = monotonic() if now is None else now
+        expired = []
+        while now - self.last_tick >= self.tick:
+            self.last_tick += self.tick
+            self.position = (self.position + 1) % len(self.slots)
+            slot = self.slots[self.position]
+            for key, turns in list(slot.items()):
+                if turns:
+                    slot[key] = turns - 1
+                else:
+                    del slot[key]
+                    del self.location[key]
+                    expired.append(key)
+        return expired
@@ -0,0 +1,134 @@
+import os
+import asyncio
+import multiprocessing
+from os import getenv
+from time import time, perf_counter
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException
+from .db import db_connection, accepts
+from .rest import verify_link
+from .codec import pack_record, unpack_records
+from . import groupcommit
+from . import metrics
+
+# Bulk export and import of live links, used to seed a new
+# deployment or move links between them. A stream is a run
+# of records, each an editor public key and the signed
+# container put under it (see rest.pack_record).
+#
+# Imports are verified exactly like puts, across
+# IMPORT_PROCESSES processes (by default at most 4, since
+# they share the machine with the serving workers), and
+# written IMPORT_BATCH_SIZE links per transaction with the
+# same rules as puts.
+EXPORT_BATCH_SIZE = int(getenv('EXPORT_BATCH_SIZE', 1000))
+IMPORT_BATCH_SIZE = int(getenv('IMPORT_BATCH_SIZE', 1000))
+IMPORT_PROCESSES  = int(getenv('IMPORT_PROCESSES', min(4, os.cpu_count() or 1)))
+
+async def export_links():
+    """
+    Yield every live link as records, a cursor batch
+    at a time, so memory stays bounded however many
+    links there are.
+    """
+    count = 0
+    cursor = db_connection().find(
+        { 'expiration': { '$gt': time() } },
+        { '_id': 0, 'editor_public_key': 1, 'container_signed': 1 }
+    ).batch_size(EXPORT_BATCH_SIZE)
+
+    try:
+        chunk = []
+        async for doc in cursor:
+            chunk.append(pack_record(doc['editor_public_key'], doc['container_signed']))
+            if len(chunk) >= EXPORT_BATCH_SIZE:
+                yield b''.join(chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            yield b''.join(chunk)
+            count += len(chunk)
+    finally:
+        await cursor.close()
+        metrics.increment('export_links', count)
+
+def verify_batch(records):
+    # Runs in an import process
+    links = []
+    invalid = 0
+    for editor_public_key, container_signed in records:
+        try:
+            links.append(verify_link(editor_public_key, container_signed))
+        except HTTPException:
+            invalid += 1
+    return links, invalid
+
+async def load_batch(links):
+    # The same replay of puts against a snapshot
+    # that group commit uses, so the outcome is
+    # as if each link had been put in turn
+    db = db_connection()
+    async with await db.database.client.start_session() as session:
+        results = await session.with_transaction(
+            lambda session: groupcommit.apply(db, session, links))
+    return sum(accepts(existing, link) for existing, link in zip(results, links))
+
+async def import_links(chunks):
+    """
+    Verify and load a stream of records arriving in
+    arbitrary chunks. Batches are verified in parallel
+    while earlier ones are written, in order.
+    """
+    start = perf_counter()
+    counts = { 'imported': 0, 'conflicts': 0, 'invalid': 0 }
+    loop = asyncio.get_running_loop()
+    buffer = bytearray()
+    batch = []
+    verifying = deque()
+
+    async def load_next():
+        links, invalid = await verifying.popleft()
+        imported = await load_batch(links) if links else 0
+        counts['imported'] += imported
+        counts['conflicts'] += len(links) - imported
+        counts['invalid'] += invalid
+
+    # Each import has its own processes, shut down without
+    # waiting if the upload fails part way, so the worker
+    # isn't held up by verifying batches nobody will load
+    pool = ProcessPoolExecutor(IMPORT_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        def submit(batch):
+            verifying.append(loop.run_in_executor(pool, verify_batch, batch))
+
+        async for chunk in chunks:
+            buffer += chunk
+            records, used = unpack_records(buffer)
+            del buffer[:used]
+            for record in records:
+                batch.append(record)
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    submit(batch)
+                    batch = []
+                    # Keep every process busy but no more
+                    # batches than that in memory
+                    if len(verifying) > 2 * IMPORT_PROCESSES:
+                        await load_next()
+
+        if batch:
+            submit(batch)
+        while verifying:
+            await load_next()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    if buffer:
+        raise HTTPException(422, 'stream ends part way through a record')
+
+    seconds = perf_counter() - start
+    metrics.increment('import_links', counts['imported'])
+    return counts | {
+        'seconds': seconds,
+        'links_per_second': sum(counts.values()) / seconds if seconds else 0
+    }